@@ -1,6 +1,13 @@
-import os
+import itertools
 import json
-from typing import Union
+import math
+from typing import Any, BinaryIO, Iterable, Iterator
+
+try:
+    # faster encoder, used if installed
+    import orjson
+except ImportError:
+    orjson = None
 
 
 from qgis.core import (
@@ -9,14 +16,81 @@ from qgis.core import (
 )
 from qgis.utils import iface
 
+# number of array items encoded at once
+JSON_CHUNK_SIZE = 1000
+JSON_WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def _encode_json(value: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass  # types orjson does not serialize, ex. float subclasses
+    try:
+        return json.dumps(value, ensure_ascii=False, allow_nan=False).encode("utf-8")
+    except ValueError:
+        # NaN and infinity are invalid JSON: null, as orjson writes them
+        return json.dumps(_replace_non_finite(value), ensure_ascii=False).encode(
+            "utf-8"
+        )
 
-def write_json(data: Union[list, dict], filepath: str):
-    # Convert dictionary to JSON string
-    json_data = json.dumps(data, ensure_ascii=False)
 
-    # Write JSON string to file
-    with open(filepath, "w") as outfile:
-        outfile.write(json_data)
+def _replace_non_finite(value: Any) -> Any:
+    """copy of value with NaN and infinite floats replaced by None"""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _replace_non_finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_replace_non_finite(item) for item in value]
+    return value
+
+
+def _dump_json_array(items: Iterable, outfile: BinaryIO):
+    outfile.write(b"[")
+    iterator = iter(items)
+    is_first = True
+    while True:
+        # encoded by chunks: memory bounded by chunk, not by array
+        chunk = list(itertools.islice(iterator, JSON_CHUNK_SIZE))
+        if len(chunk) == 0:
+            break
+        if not is_first:
+            outfile.write(b",")
+        outfile.write(_encode_json(chunk)[1:-1])
+        is_first = False
+    outfile.write(b"]")
+
+
+def dump_json(data: Any, outfile: BinaryIO):
+    """
+    Write data as UTF-8 JSON to a binary file, streaming arrays: lists and
+    iterators, ex. generators, are consumed and written by chunks of items
+
+    Args:
+        data (Any): dict, list or iterator, nested in dicts
+        outfile (BinaryIO): file opened in binary mode
+    """
+    if isinstance(data, dict):
+        outfile.write(b"{")
+        for i, (key, value) in enumerate(data.items()):
+            if i > 0:
+                outfile.write(b",")
+            outfile.write(_encode_json(str(key)))
+            outfile.write(b":")
+            dump_json(value, outfile)
+        outfile.write(b"}")
+    elif isinstance(data, (list, tuple, Iterator)):
+        _dump_json_array(data, outfile)
+    else:
+        outfile.write(_encode_json(data))
+
+
+def write_json(data: Any, filepath: str):
+    """write data to file with dump_json, through a write buffer"""
+    with open(filepath, "wb", buffering=JSON_WRITE_BUFFER_SIZE) as outfile:
+        dump_json(data, outfile)
 
 
 def convert_to_point(value: float, unit: QgsUnitTypes.RenderUnit) -> float:
@@ -48,10 +122,8 @@ def convert_to_point(value: float, unit: QgsUnitTypes.RenderUnit) -> float:
         return value * 72
 
 
-def get_tempdir(output_dir: str) -> str:
-    """return tempdir path shared by all modules. if not exists, create it."""
-    temp_dir_path = os.path.join(output_dir, "temp")
-    if not os.path.exists(os.path.join(output_dir, temp_dir_path)):
-        os.mkdir(os.path.join(output_dir, temp_dir_path))
-
-    return os.path.join(output_dir, temp_dir_path)
+def convert_point_to_map_units(value: float) -> float:
+    """calculate value in point to map units, at scale of map canvas"""
+    canvas = iface.mapCanvas()
+    # 1pt = 1/72 inch
+    return value / 72 * canvas.mapSettings().outputDpi() * canvas.mapUnitsPerPixel()
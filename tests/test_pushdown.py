@@ -0,0 +1,151 @@
+import os
+import tempfile
+import unittest
+
+from qgis.core import (
+    NULL,
+    QgsCoordinateReferenceSystem,
+    QgsFeature,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsMarkerSymbol,
+    QgsPointXY,
+    QgsRendererCategory,
+    QgsRendererRange,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+    QgsWkbTypes,
+)
+from qgis.PyQt.QtCore import QVariant
+
+from translator.vector.process import (
+    _classify_by_range,
+    _create_filter_request,
+    _get_category_filter_expression,
+    _get_range_filter_expression,
+    _partition_by_category,
+    _supports_pushdown,
+)
+
+CLASS_VALUES = ["a", "b", "c", NULL, "", "a", "b", NULL]
+
+
+class TestPushdown(unittest.TestCase):
+    """Test that filters pushed down to provider select the same features
+    as bucketing in Python, against a local GeoPackage file.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        gpkg_path = os.path.join(self.tempdir.name, "pushdown.gpkg")
+
+        fields = QgsFields()
+        fields.append(QgsField("class", QVariant.String))
+        fields.append(QgsField("value", QVariant.Double))
+        writer = QgsVectorFileWriter(
+            gpkg_path,
+            "UTF-8",
+            fields,
+            QgsWkbTypes.Point,
+            QgsCoordinateReferenceSystem("EPSG:4326"),
+            "GPKG",
+        )
+        for i, class_value in enumerate(CLASS_VALUES):
+            feature = QgsFeature(fields)
+            feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(i, i)))
+            feature.setAttributes([class_value, i * 1.5 if i != 3 else NULL])
+            writer.addFeature(feature)
+        del writer
+
+        self.layer = QgsVectorLayer(gpkg_path, "pushdown", "ogr")
+        self.assertTrue(self.layer.isValid())
+
+    def tearDown(self):
+        del self.layer
+        self.tempdir.cleanup()
+
+    def _fids(self, filter_expression: str) -> set:
+        request = _create_filter_request(filter_expression)
+        return {feature.id() for feature in self.layer.getFeatures(request)}
+
+    def test_supports_pushdown(self):
+        self.assertTrue(_supports_pushdown(self.layer))
+
+        memory_layer = QgsVectorLayer("Point?crs=EPSG:4326", "memory", "memory")
+        self.assertFalse(_supports_pushdown(memory_layer))
+
+    def test_category_filter(self):
+        symbol = QgsMarkerSymbol()
+        categories = [
+            QgsRendererCategory("a", symbol.clone(), "a"),
+            QgsRendererCategory("b", symbol.clone(), "b"),
+            QgsRendererCategory("", symbol.clone(), "all other values"),
+        ]
+        buckets = _partition_by_category(
+            self.layer.getFeatures(), lambda f: f["class"], categories
+        )
+
+        for sub_idx, category in enumerate(categories):
+            filter_expression = _get_category_filter_expression(
+                "class", category, categories
+            )
+            self.assertEqual(
+                self._fids(filter_expression),
+                {feature.id() for feature in buckets[sub_idx]},
+            )
+
+    def test_merged_category_filter(self):
+        symbol = QgsMarkerSymbol()
+        categories = [
+            QgsRendererCategory(["a", "b"], symbol.clone(), "a, b"),
+            QgsRendererCategory("", symbol.clone(), "all other values"),
+        ]
+        buckets = _partition_by_category(
+            self.layer.getFeatures(), lambda f: f["class"], categories
+        )
+        self.assertEqual(len(buckets[0]), 4)
+
+        for sub_idx, category in enumerate(categories):
+            filter_expression = _get_category_filter_expression(
+                "class", category, categories
+            )
+            self.assertEqual(
+                self._fids(filter_expression),
+                {feature.id() for feature in buckets[sub_idx]},
+            )
+
+    def test_range_filter(self):
+        symbol = QgsMarkerSymbol()
+        ranges = [
+            QgsRendererRange(0.0, 3.0, symbol.clone(), "0 - 3"),
+            QgsRendererRange(3.0, 6.0, symbol.clone(), "3 - 6"),
+            QgsRendererRange(6.0, 12.0, symbol.clone(), "6 - 12"),
+        ]
+        fids_by_range = _classify_by_range(
+            self.layer.getFeatures(), lambda f: f["value"], ranges
+        )
+
+        for sub_idx in fids_by_range:
+            filter_expression = _get_range_filter_expression("value", sub_idx, ranges)
+            self.assertEqual(self._fids(filter_expression), fids_by_range[sub_idx])
+
+    def test_overlapping_range_filter(self):
+        symbol = QgsMarkerSymbol()
+        ranges = [
+            QgsRendererRange(0.0, 6.0, symbol.clone(), "0 - 6"),
+            QgsRendererRange(3.0, 12.0, symbol.clone(), "3 - 12"),
+        ]
+        fids_by_range = _classify_by_range(
+            self.layer.getFeatures(), lambda f: f["value"], ranges
+        )
+        # first matching range in order, as QGIS
+        self.assertEqual(len(fids_by_range[0]), 3)
+
+        for sub_idx in fids_by_range:
+            filter_expression = _get_range_filter_expression("value", sub_idx, ranges)
+            self.assertEqual(self._fids(filter_expression), fids_by_range[sub_idx])
+
+
+if __name__ == "__main__":
+    unittest.main()
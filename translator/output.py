@@ -0,0 +1,154 @@
+import os
+import shutil
+import time
+import zipfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from osgeo import gdal
+
+from plugx_utils import dump_json, write_json
+
+# size of chunks copied from in-memory files to package
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class Output(ABC):
+    """
+    Destination of exported files, named by paths relative to output root
+    separated by "/", ex. "layer_0.json", "assets/some.svg"
+    """
+
+    @abstractmethod
+    def write_json(self, data: Any, name: str):
+        pass
+
+    @abstractmethod
+    def write_bytes(self, data: bytes, name: str):
+        pass
+
+    @abstractmethod
+    def copy_file(self, src_path: str, name: str):
+        pass
+
+    @abstractmethod
+    @contextmanager
+    def vector_file(self, name: str) -> Iterator[str]:
+        """path for QgsVectorFileWriter, output when the block exits"""
+
+    @abstractmethod
+    def location(self) -> str:
+        """path of output shown to user"""
+
+    def close(self):
+        pass
+
+
+class FolderOutput(Output):
+    """files written in a folder"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def _path(self, name: str) -> str:
+        path = os.path.join(self.output_dir, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def write_json(self, data: Any, name: str):
+        write_json(data, self._path(name))
+
+    def write_bytes(self, data: bytes, name: str):
+        with open(self._path(name), "wb") as f:
+            f.write(data)
+
+    def copy_file(self, src_path: str, name: str):
+        shutil.copy(src_path, self._path(name))
+
+    @contextmanager
+    def vector_file(self, name: str) -> Iterator[str]:
+        yield self._path(name)
+
+    def location(self) -> str:
+        return self.output_dir
+
+
+class PackageOutput(Output):
+    """
+    files streamed into a single zip package as they are produced,
+    without files in file system
+    """
+
+    def __init__(self, zip_path: str, compress_png: bool = True):
+        """
+        Args:
+            zip_path (str): path of package
+            compress_png (bool, optional): False to store PNG files as they are,
+                already compressed. Defaults to True.
+        """
+        self.zip_path = zip_path
+        self.compress_png = compress_png
+        self.package = zipfile.ZipFile(
+            zip_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True
+        )
+        self.names = set()
+        self.nb_vector_files = 0
+
+    def _open(self, name: str):
+        self.names.add(name)
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        if name.endswith(".png") and not self.compress_png:
+            info.compress_type = zipfile.ZIP_STORED
+        return self.package.open(info, "w", force_zip64=True)
+
+    def write_json(self, data: Any, name: str):
+        with self._open(name) as f:
+            dump_json(data, f)
+
+    def write_bytes(self, data: bytes, name: str):
+        with self._open(name) as f:
+            f.write(data)
+
+    def copy_file(self, src_path: str, name: str):
+        # same asset can be used by several symbols
+        if name in self.names:
+            return
+        with open(src_path, "rb") as src, self._open(name) as f:
+            shutil.copyfileobj(src, f, COPY_CHUNK_SIZE)
+
+    @contextmanager
+    def vector_file(self, name: str) -> Iterator[str]:
+        # written in memory by GDAL, with its sidecar files, then moved to package
+        self.nb_vector_files += 1
+        vsimem_dir = f"/vsimem/plugx_{id(self)}_{self.nb_vector_files}"
+        try:
+            yield f"{vsimem_dir}/{os.path.basename(name)}"
+
+            name_dir = os.path.dirname(name)
+            for filename in gdal.ReadDir(vsimem_dir) or []:
+                self._copy_vsimem_file(
+                    f"{vsimem_dir}/{filename}",
+                    f"{name_dir}/{filename}" if name_dir else filename,
+                )
+        finally:
+            gdal.RmdirRecursive(vsimem_dir)
+
+    def _copy_vsimem_file(self, vsimem_path: str, name: str):
+        src = gdal.VSIFOpenL(vsimem_path, "rb")
+        try:
+            with self._open(name) as f:
+                while True:
+                    chunk = gdal.VSIFReadL(1, COPY_CHUNK_SIZE, src)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        finally:
+            gdal.VSIFCloseL(src)
+
+    def location(self) -> str:
+        return self.zip_path
+
+    def close(self):
+        self.package.close()
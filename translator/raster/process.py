@@ -1,7 +1,5 @@
-import os
-
 from qgis.core import (
-    QgsRasterLayer,
+    QgsMapLayer,
     QgsRectangle,
     QgsProject,
     QgsMapSettings,
@@ -9,16 +7,18 @@ from qgis.core import (
     QgsCoordinateTransform,
 )
 from qgis.utils import iface
-from qgis.PyQt.QtCore import QSize
+from qgis.PyQt.QtCore import QBuffer, QByteArray, QIODevice, QSize
 from qgis.PyQt.QtGui import QColor
 
-from plugx_utils import write_json
+from translator.output import Output
 from translator.utils import get_blend_mode_string
 
 
-def process_raster(
-    layer: QgsRasterLayer, extent: QgsRectangle, idx: int, output_dir: str
-):
+def process_raster(layer: QgsMapLayer, extent: QgsRectangle, idx: int, output: Output):
+    """
+    render layer as png with world file, also used for vector layers too dense
+    to export as vector
+    """
     # transform layer-extent to project-crs
     transform = QgsCoordinateTransform(
         layer.crs(),
@@ -56,6 +56,8 @@ def process_raster(
     settings.setLayers([_layer])
     settings.setExtent(intersected_extent)
     settings.setOutputSize(QSize(image_width, image_height))
+    # labels are exported separately as label json
+    settings.setFlag(QgsMapSettings.Flag.DrawLabeling, False)
 
     # Render the map
     render = QgsMapRendererParallelJob(settings)
@@ -64,12 +66,17 @@ def process_raster(
 
     # export rendered image as png
     image = render.renderedImage()
-    image.save(os.path.join(output_dir, f"layer_{idx}.png"), "png")
+    png = QByteArray()
+    buffer = QBuffer(png)
+    buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+    image.save(buffer, "png")
+    buffer.close()
+    output.write_bytes(bytes(png), f"layer_{idx}.png")
 
     # make world file for check
-    with open(os.path.join(output_dir, f"layer_{idx}.pgw"), "w") as f:
-        f.write(f"{units_per_pixel}\n0.0\n0.0\n-{units_per_pixel}\n")
-        f.write(f"{intersected_extent.xMinimum()}\n{intersected_extent.yMaximum()}\n")
+    world_file = f"{units_per_pixel}\n0.0\n0.0\n-{units_per_pixel}\n"
+    world_file += f"{intersected_extent.xMinimum()}\n{intersected_extent.yMaximum()}\n"
+    output.write_bytes(world_file.encode("utf-8"), f"layer_{idx}.pgw")
 
     # json
     raster_info = {
@@ -84,7 +91,7 @@ def process_raster(
         "opacity": layer.opacity(),
         "blend_mode": get_blend_mode_string(layer.blendMode()),
     }
-    write_json(raster_info, os.path.join(output_dir, f"layer_{idx}.json"))
+    output.write_json(raster_info, f"layer_{idx}.json")
 
     return {
         "idx": idx,
@@ -1,9 +1,14 @@
-from qgis.core import QgsRasterLayer, QgsVectorLayer
+from qgis.core import QgsFeedback, QgsRasterLayer, QgsVectorLayer
 from qgis.PyQt.QtCore import QThread, pyqtSignal
 
 from translator.raster.process import process_raster
 from translator.vector.process import process_vector
-from translator.vector.label import generate_label_json
+from translator.vector.label import (
+    generate_label_json,
+    generate_label_positions,
+    generate_tiled_label_positions,
+    group_labels_by_layer,
+)
 
 
 class ProcessingThread(QThread):
@@ -14,20 +19,55 @@ class ProcessingThread(QThread):
     setAbortable = pyqtSignal(bool)
     processFailed = pyqtSignal(str)
 
-    def __init__(self, layers: list, all_labels: QgsVectorLayer, params: dict):
+    def __init__(self, layers: list, params: dict):
         super().__init__()
 
         self.layers = layers
-        self.all_labels = all_labels
         self.params = params
         self.abort_flag = False
+        # cancel long stages, not only between layers
+        self.feedback = QgsFeedback()
 
+        self.labels_by_layer = {}
         self.results = []
 
     def set_abort_flag(self, flag=True):
         self.abort_flag = flag
+        if flag:
+            self.feedback.cancel()
+
+    def _extract_labels(self) -> dict:
+        """labels of checked layers with labels enabled, {layer id: labels}"""
+        labelled_layers = [
+            layer
+            for layer in self.layers
+            if isinstance(layer, QgsVectorLayer) and layer.labelsEnabled()
+        ]
+        if len(labelled_layers) == 0:
+            return {}
+
+        if self.params["options"]["tile_labels"]:
+            label_positions = generate_tiled_label_positions(
+                self.params["extent"], labelled_layers, self.feedback
+            )
+        else:
+            label_positions = generate_label_positions(
+                self.params["extent"], labelled_layers, self.feedback
+            )
+        if label_positions is None:
+            return {}  # canceled
+        return group_labels_by_layer(label_positions)
 
     def run(self):
+        try:
+            self.postMessage.emit("Extracting labels")
+            self.setAbortable.emit(True)
+            self.labels_by_layer = self._extract_labels()
+            self.addProgress.emit(1)
+        except Exception as e:
+            self.processFailed.emit(f"labels - error:{str(e)}")
+            return
+
         try:
             for idx, layer in enumerate(self.layers):
                 if self.abort_flag:
@@ -35,20 +75,25 @@ class ProcessingThread(QThread):
 
                 if isinstance(layer, QgsRasterLayer):
                     result = process_raster(
-                        layer, self.params["extent"], idx, self.params["output_dir"]
+                        layer, self.params["extent"], idx, self.params["output"]
                     )
                     self.results.append(result)
                 elif isinstance(layer, QgsVectorLayer):
                     result = process_vector(
-                        layer, self.params["extent"], idx, self.params["output_dir"]
+                        layer,
+                        self.params["extent"],
+                        idx,
+                        self.params["output"],
+                        self.params["options"],
                     )
 
                     if layer.labelsEnabled():
                         generate_label_json(
-                            self.all_labels,
+                            self.labels_by_layer.get(layer.id(), []),
                             layer.name(),
                             idx,
-                            self.params["output_dir"],
+                            self.params["output"],
+                            self.params["options"],
                         )
                     self.results.append(result)
 
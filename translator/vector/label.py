@@ -1,72 +1,508 @@
-import os
-import processing
+import math
+from functools import lru_cache
+from typing import Iterable, Iterator, Optional, Tuple
 
-from qgis.core import QgsVectorLayer, QgsRectangle
+from qgis.core import (
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsFeedback,
+    QgsLabelingResults,
+    QgsLabelPosition,
+    QgsMapRendererCustomPainterJob,
+    QgsMapSettings,
+    QgsNullPaintDevice,
+    QgsPointXY,
+    QgsProject,
+    QgsRectangle,
+    QgsRenderContext,
+    QgsTextFormat,
+    QgsUnitTypes,
+)
 from qgis.utils import iface
+from qgis.PyQt.QtCore import QSize, Qt, QThread
+from qgis.PyQt.QtGui import QFont, QFontMetricsF, QImage, QPainter
 
-from plugx_utils import write_json
+from plugx_utils import convert_to_point
+from translator.output import Output
+from translator.vector.symbol.utils import to_rgba
 
+# tiled extraction of labels: size of tiles and margin around them, in pixels
+LABEL_TILE_SIZE = 2048
+LABEL_TILE_MARGIN = 256
+# number of tiles labelled at once
+LABEL_TILE_CONCURRENCY = max(1, min(4, QThread.idealThreadCount()))
 
-def generate_label_json(
-    all_labels_layer: QgsVectorLayer, layername: str, idx: int, output_dir: str
-):
-    label_layer = processing.run(
-        "native:extractbyattribute",
-        {
-            "INPUT": all_labels_layer,
-            "FIELD": "Layer",
-            "OPERATOR": 0,  # '='
-            "VALUE": layername,
-            "OUTPUT": "TEMPORARY_OUTPUT",
-        },
-    )["OUTPUT"]
-
-    labels = []
-    for feature in label_layer.getFeatures():
-        if not feature["LabelUnplaced"]:
-            # バッファーがない場合は色を#000000にする
-            buffer_color = (
-                "#000000" if not feature["BufferColor"] else str(feature["BufferColor"])
+# number of distinct font and text measured, labels often repeat same text
+LABEL_METRICS_CACHE_SIZE = 65536
+_metrics_device = None
+
+# columnar label json: values of each label, and keys of styles shared by labels
+LABEL_COLUMNS = ("x", "y", "rotation", "text")
+LABEL_METRIC_COLUMNS = ("text:width", "text:height", "text:baseline")
+LABEL_STYLE_KEYS = (
+    "font",
+    "size",
+    "bold",
+    "underline",
+    "text:color",
+    "text:opacity",
+    "buffer:width",
+    "buffer:color",
+    "buffer:opacity",
+)
+
+
+def _get_canvas_labeling_results(
+    extent: QgsRectangle, layers: list
+) -> Optional[QgsLabelingResults]:
+    """
+    labeling results of map canvas if it shows extent and all of layers,
+    else None
+    """
+    canvas = iface.mapCanvas()
+    if canvas.extent() != extent:
+        return None
+
+    canvas_layer_ids = {canvas_layer.id() for canvas_layer in canvas.layers()}
+    if any(layer.id() not in canvas_layer_ids for layer in layers):
+        return None
+    return canvas.labelingResults()
+
+
+def _create_labeling_job(
+    extent: QgsRectangle, layers: list, feedback: Optional[QgsFeedback] = None
+) -> tuple:
+    """
+    job rendering labels of layers only, at scale of map canvas.
+    Painted on a null device, as native:extractlabels: no image of output
+    size is allocated
+
+    Returns:
+        tuple: job, its painter and paint device, kept alive until
+            _finish_labeling_job
+    """
+    # same as canvas but extent and layers, size in pixels at canvas resolution
+    canvas = iface.mapCanvas()
+    units_per_pixel = canvas.mapUnitsPerPixel()
+    settings = QgsMapSettings(canvas.mapSettings())
+    settings.setLayers(layers)
+    settings.setExtent(extent)
+    settings.setOutputSize(
+        QSize(
+            int(extent.width() / units_per_pixel),
+            int(extent.height() / units_per_pixel),
+        )
+    )
+    # labeling engine only, symbols are exported separately
+    settings.setFlag(QgsMapSettings.Flag.DrawLabeling, True)
+    settings.setFlag(QgsMapSettings.Flag.SkipSymbolRendering, True)
+
+    device = QgsNullPaintDevice()
+    device.setOutputSize(settings.outputSize())
+    device.setOutputDpi(round(settings.outputDpi()))
+    painter = QPainter(device)
+
+    job = QgsMapRendererCustomPainterJob(settings, painter)
+    if feedback is not None:
+        # called from thread requesting cancel, job runs in its own thread
+        feedback.canceled.connect(
+            job.cancelWithoutBlocking, Qt.ConnectionType.DirectConnection
+        )
+    return job, painter, device
+
+
+def _finish_labeling_job(labeling_job: tuple) -> QgsLabelingResults:
+    """wait for a started job created by _create_labeling_job"""
+    job, painter, _ = labeling_job
+    job.waitForFinished()
+    painter.end()
+    return job.takeLabelingResults()
+
+
+def generate_label_positions(
+    extent: QgsRectangle, layers: list, feedback: Optional[QgsFeedback] = None
+) -> Optional[list]:
+    """
+    Labels of layers at scale of map canvas, running the labeling engine
+    at most once: results of map canvas are reused if it shows extent,
+    else map is rendered with labels of layers only
+
+    Args:
+        extent (QgsRectangle): in Project CRS
+        layers (list): labelled layers to extract labels of
+        feedback (QgsFeedback, optional): to cancel rendering
+
+    Returns:
+        list: QgsLabelPosition of layers, may include other layers of canvas.
+            None if canceled
+    """
+    canvas_results = _get_canvas_labeling_results(extent, layers)
+    if canvas_results is not None:
+        return canvas_results.allLabels()
+
+    labeling_job = _create_labeling_job(extent, layers, feedback)
+    labeling_job[0].start()
+    results = _finish_labeling_job(labeling_job)
+
+    if feedback is not None and feedback.isCanceled():
+        return None
+    return results.allLabels()
+
+
+def _split_extent(extent: QgsRectangle, tile_size: float) -> list:
+    """split extent into tiles of tile_size, smaller at right and top edges"""
+    nb_columns = max(1, math.ceil(extent.width() / tile_size))
+    nb_rows = max(1, math.ceil(extent.height() / tile_size))
+    tiles = []
+    for row in range(nb_rows):
+        for column in range(nb_columns):
+            x_min = extent.xMinimum() + column * tile_size
+            y_min = extent.yMinimum() + row * tile_size
+            tiles.append(
+                QgsRectangle(
+                    x_min,
+                    y_min,
+                    min(x_min + tile_size, extent.xMaximum()),
+                    min(y_min + tile_size, extent.yMaximum()),
+                )
             )
+    return tiles
+
+
+def _repeats_labels(label_position: QgsLabelPosition) -> bool:
+    """whether labeling settings of the label repeat it along lines"""
+    layer = QgsProject.instance().mapLayer(label_position.layerID)
+    settings = layer.labeling().settings(label_position.providerID)
+    return settings.repeatDistance > 0
+
+
+def generate_tiled_label_positions(
+    extent: QgsRectangle, layers: list, feedback: Optional[QgsFeedback] = None
+) -> Optional[list]:
+    """
+    Labels of layers at scale of map canvas, extracted tile by tile to bound
+    memory of the labeling engine by tile size.
+    Each tile is labelled with a margin so that labels near its edges are
+    placed as in whole extent, and keeps only labels centered in itself.
+    A feature spanning tiles is labelled by each of them: its label is kept
+    once, or once per placement if labels are repeated along lines.
+
+    Args:
+        extent (QgsRectangle): in Project CRS
+        layers (list): labelled layers to extract labels of
+        feedback (QgsFeedback, optional): to cancel rendering
+
+    Returns:
+        list: placed QgsLabelPosition of layers, without diagrams.
+            None if canceled
+    """
+    canvas_results = _get_canvas_labeling_results(extent, layers)
+    if canvas_results is not None:
+        return canvas_results.allLabels()
+
+    units_per_pixel = iface.mapCanvas().mapUnitsPerPixel()
+    tiles = _split_extent(extent, LABEL_TILE_SIZE * units_per_pixel)
+    margin = LABEL_TILE_MARGIN * units_per_pixel
 
-            labels.append(
-                {
-                    "x": feature.geometry().asPoint().x(),
-                    "y": feature.geometry().asPoint().y(),
-                    "rotation": feature["LabelRotation"],
-                    "text": feature["LabelText"],
-                    "font": feature["Family"],
-                    "size": feature["Size"],
-                    "bold": feature["Bold"],
-                    "underline": feature["Underline"],
-                    "text:color": feature["Color"],
-                    "text:opacity": feature["FontOpacity"],
-                    "buffer:width": feature["BufferSize"],
-                    "buffer:color": buffer_color,
-                    "buffer:opacity": feature["BufferOpacity"],
-                }
+    label_positions = []
+    # (layer, feature, text): [(tile index, center)] of labels kept
+    kept_labels = {}
+    # (layer, labeling rule): whether labels of a feature are repeated
+    repeats_labels = {}
+    for batch_start in range(0, len(tiles), LABEL_TILE_CONCURRENCY):
+        # jobs render in their own threads: run a few tiles concurrently
+        batch = [
+            (tile_idx, tiles[tile_idx])
+            for tile_idx in range(
+                batch_start, min(batch_start + LABEL_TILE_CONCURRENCY, len(tiles))
             )
+        ]
+        labeling_jobs = [
+            _create_labeling_job(tile.buffered(margin), layers, feedback)
+            for _, tile in batch
+        ]
+        for labeling_job in labeling_jobs:
+            labeling_job[0].start()
+        results = [_finish_labeling_job(labeling_job) for labeling_job in labeling_jobs]
 
-    if len(labels) > 0:
-        label_dict = {"layer": layername, "labels": labels}
-        write_json(
-            label_dict,
-            os.path.join(output_dir, f"label_{idx}.json"),
-        )
+        if feedback is not None and feedback.isCanceled():
+            return None
+
+        for (tile_idx, tile), tile_results in zip(batch, results):
+            for label_position in tile_results.allLabels():
+                if label_position.isUnplaced or label_position.isDiagram:
+                    continue
+
+                # label in margin belongs to neighbour tile
+                center = label_position.labelRect.center()
+                if not tile.contains(center):
+                    continue
+
+                identity = (
+                    label_position.layerID,
+                    label_position.featureId,
+                    label_position.labelText,
+                )
+                kept = kept_labels.setdefault(identity, [])
+                if len(kept) > 0:
+                    settings_key = (label_position.layerID, label_position.providerID)
+                    if settings_key not in repeats_labels:
+                        repeats_labels[settings_key] = _repeats_labels(label_position)
+                    # one label per feature, unless labels are repeated along
+                    # lines: then same label placed by two tiles is kept once
+                    if not repeats_labels[settings_key] or any(
+                        kept_tile_idx != tile_idx
+                        and center.distance(kept_center) < margin
+                        for kept_tile_idx, kept_center in kept
+                    ):
+                        continue
+                kept.append((tile_idx, center))
+                label_positions.append(label_position)
+
+    return label_positions
+
+
+def _get_label_settings(label_position: QgsLabelPosition) -> tuple:
+    """
+    labeling settings the label was placed with, and render context to
+    evaluate their data-defined properties for features of the layer
+
+    Returns:
+        tuple: QgsVectorLayer, QgsPalLayerSettings, QgsRenderContext
+    """
+    layer = QgsProject.instance().mapLayer(label_position.layerID)
+    settings = layer.labeling().settings(label_position.providerID)
+
+    map_settings = iface.mapCanvas().mapSettings()
+    context = QgsRenderContext.fromMapSettings(map_settings)
+    expression_context = QgsExpressionContext(
+        QgsExpressionContextUtils.globalProjectLayerScopes(layer)
+    )
+    expression_context.appendScope(
+        QgsExpressionContextUtils.mapSettingsScope(map_settings)
+    )
+    context.setExpressionContext(expression_context)
+    return layer, settings, context
 
 
-def generate_label_vector(extent: QgsRectangle) -> QgsVectorLayer:
-    """export QgsVectorLayer of label, includes all layers"""
-    label = processing.run(
-        "native:extractlabels",
-        {
-            "EXTENT": extent,
-            "SCALE": iface.mapCanvas().scale(),
-            "MAP_THEME": None,
-            "INCLUDE_UNPLACED": True,
-            "DPI": iface.mapCanvas().mapSettings().outputDpi(),
-            "OUTPUT": "TEMPORARY_OUTPUT",
-        },
-    )["OUTPUT"]
-
-    return label
+def _get_text_format(
+    label_position: QgsLabelPosition, label_settings: tuple
+) -> QgsTextFormat:
+    """
+    text format of the label: data-defined size, color and buffer of
+    labeling settings evaluated for its feature
+
+    Args:
+        label_position (QgsLabelPosition): placed label
+        label_settings (tuple): output of _get_label_settings for the label
+
+    Returns:
+        QgsTextFormat: static format of settings if none is data-defined
+    """
+    layer, settings, context = label_settings
+    text_format = settings.format()
+    properties = settings.dataDefinedProperties()
+    if not properties.hasActiveProperties():
+        return text_format
+
+    feature = layer.getFeature(label_position.featureId)
+    if not feature.isValid():
+        return text_format
+    context.expressionContext().setFeature(feature)
+
+    text_format = QgsTextFormat(text_format)
+    text_format.setDataDefinedProperties(properties)
+    text_format.updateDataDefinedProperties(context)
+    return text_format
+
+
+def _get_font_size(font: QFont) -> float:
+    """size of a placed font in points"""
+    if font.pointSizeF() > 0:
+        return font.pointSizeF()
+    return convert_to_point(font.pixelSize(), QgsUnitTypes.RenderPixels)
+
+
+def _get_label_data(label_position: QgsLabelPosition, text_format: QgsTextFormat):
+    # 回転したラベルの左下を原点とする
+    if len(label_position.cornerPoints) > 0:
+        origin = label_position.cornerPoints[0]
+    else:
+        rect = label_position.labelRect
+        origin = QgsPointXY(rect.xMinimum(), rect.yMinimum())
+
+    # 単位をポイントに変換できない場合は、配置されたフォントのサイズ
+    size = convert_to_point(text_format.size(), text_format.sizeUnit())
+    if size is None:
+        size = _get_font_size(label_position.labelFont)
+
+    # バッファーがない場合は色を#000000にする
+    buffer = text_format.buffer()
+    if buffer.enabled():
+        buffer_width = convert_to_point(buffer.size(), buffer.sizeUnit())
+        buffer_color = to_rgba(buffer.color())
+    else:
+        buffer_width = 0.0
+        buffer_color = "#000000"
+
+    return {
+        "x": origin.x(),
+        "y": origin.y(),
+        "rotation": math.degrees(label_position.rotation) % 360,
+        "text": label_position.labelText,
+        "font": label_position.labelFont.family(),
+        "size": size,
+        "bold": label_position.labelFont.bold(),
+        "underline": label_position.labelFont.underline(),
+        "text:color": to_rgba(text_format.color()),
+        "text:opacity": text_format.opacity() * 100,
+        "buffer:width": buffer_width,
+        "buffer:color": buffer_color,
+        "buffer:opacity": buffer.opacity() * 100,
+    }
+
+
+def _get_metrics_device() -> QImage:
+    """paint device of 72 dpi: font metrics are measured in points"""
+    global _metrics_device
+    if _metrics_device is None:
+        _metrics_device = QImage(1, 1, QImage.Format.Format_ARGB32)
+        dots_per_meter = round(72 / 0.0254)
+        _metrics_device.setDotsPerMeterX(dots_per_meter)
+        _metrics_device.setDotsPerMeterY(dots_per_meter)
+    return _metrics_device
+
+
+@lru_cache(maxsize=LABEL_METRICS_CACHE_SIZE)
+def _measure_text(
+    family: str, size: float, bold: bool, underline: bool, text: str
+) -> Tuple[float, float, float]:
+    """
+    width, height and baseline offset from top of text, in points.
+    lines of multiline text are stacked by line spacing
+    """
+    font = QFont(family)
+    font.setPointSizeF(size)
+    font.setBold(bold)
+    font.setUnderline(underline)
+    metrics = QFontMetricsF(font, _get_metrics_device())
+
+    lines = text.split("\n")
+    width = max(metrics.horizontalAdvance(line) for line in lines)
+    height = metrics.lineSpacing() * (len(lines) - 1) + metrics.height()
+    return width, height, metrics.ascent()
+
+
+def _add_label_metrics(label: dict):
+    width, height, baseline = _measure_text(
+        label["font"], label["size"], label["bold"], label["underline"], label["text"]
+    )
+    label["text:width"] = width
+    label["text:height"] = height
+    label["text:baseline"] = baseline
+
+
+def group_labels_by_layer(label_positions: Iterable[QgsLabelPosition]) -> dict:
+    """
+    Distribute placed labels of all layers to layers in a single pass,
+    without diagrams
+
+    Args:
+        label_positions (Iterable[QgsLabelPosition]): output of
+            generate_label_positions or generate_tiled_label_positions
+
+    Returns:
+        dict: {layer id: list of QgsLabelPosition}
+    """
+    positions_by_layer = {}
+    for label_position in label_positions:
+        # diagrams are placed by labeling engine too, they have no text
+        if label_position.isUnplaced or label_position.isDiagram:
+            continue
+        positions_by_layer.setdefault(label_position.layerID, []).append(label_position)
+    return positions_by_layer
+
+
+def _iter_label_data(
+    label_positions: Iterable[QgsLabelPosition], with_metrics: bool
+) -> Iterator[dict]:
+    """
+    Label dicts, produced one by one while writing
+
+    Args:
+        label_positions (Iterable[QgsLabelPosition]): placed labels of a layer
+        with_metrics (bool): add size of text measured with its font,
+            so that it needs not to be measured again
+    """
+    # one settings per labeling rule
+    label_settings = {}
+
+    for label_position in label_positions:
+        key = (label_position.layerID, label_position.providerID)
+        if key not in label_settings:
+            label_settings[key] = _get_label_settings(label_position)
+
+        text_format = _get_text_format(label_position, label_settings[key])
+        label = _get_label_data(label_position, text_format)
+        if with_metrics:
+            _add_label_metrics(label)
+        yield label
+
+
+def _to_columnar(labels: Iterable[dict], precision: int, with_metrics: bool) -> dict:
+    """
+    Labels as columns of values, styles shared by labels stored once,
+    built in a single pass over labels
+
+    Args:
+        labels (Iterable[dict]): label dicts
+        precision (int): number of decimals of coordinates
+        with_metrics (bool): labels have size of text
+
+    Returns:
+        dict: columns, "style" index of each label and "styles" table
+    """
+    columns = {key: [] for key in LABEL_COLUMNS}
+    metric_keys = LABEL_METRIC_COLUMNS if with_metrics else ()
+    for key in metric_keys:
+        columns[key] = []
+    columns["style"] = []
+
+    style_idxs = {}
+    for label in labels:
+        columns["x"].append(round(label["x"], precision))
+        columns["y"].append(round(label["y"], precision))
+        columns["rotation"].append(label["rotation"])
+        columns["text"].append(label["text"])
+        for key in metric_keys:
+            columns[key].append(label.get(key))
+
+        style = tuple(label[key] for key in LABEL_STYLE_KEYS)
+        columns["style"].append(style_idxs.setdefault(style, len(style_idxs)))
+
+    columns["styles"] = [dict(zip(LABEL_STYLE_KEYS, style)) for style in style_idxs]
+    return columns
+
+
+def generate_label_json(
+    label_positions: list, layername: str, idx: int, output: Output, options: dict
+):
+    """
+    write label json of a layer, labels grouped by group_labels_by_layer.
+    label dicts are streamed to the file, not kept in memory; columns of
+    the columnar format are built in memory in one pass
+    """
+    if len(label_positions) == 0:
+        return
+
+    with_metrics = options.get("label_metrics", False)
+    labels = _iter_label_data(label_positions, with_metrics)
+    if options.get("label_columnar"):
+        label_dict = {
+            "layer": layername,
+            "format": "columnar",
+            **_to_columnar(labels, options["label_precision"], with_metrics),
+        }
+    else:
+        label_dict = {"layer": layername, "labels": labels}
+    output.write_json(label_dict, f"label_{idx}.json")
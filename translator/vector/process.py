@@ -1,69 +1,500 @@
-import os
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
 
-import processing
+import numpy as np
 from qgis.core import (
+    Qgis,
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsExpression,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsGeometryEngine,
+    QgsPointXY,
     QgsProject,
+    QgsRenderContext,
+    QgsRendererCategory,
+    QgsRendererRange,
+    QgsRuleBasedRenderer,
+    QgsSymbol,
+    QgsSymbolLayer,
+    QgsUnitTypes,
     QgsVectorFileWriter,
     QgsVectorLayer,
     QgsRectangle,
+    QgsWkbTypes,
     NULL,
 )
+from qgis.PyQt.QtCore import QPointF, QVariant
+from qgis.PyQt.QtGui import QColor, QPolygonF
+from qgis.utils import iface
+
 from .symbol import (
     generate_symbols_data,
     export_assets_from,
     is_included_unsupported_symbol_layer,
 )
+from .symbol.utils import to_rgba
 
-from plugx_utils import write_json
+from plugx_utils import convert_point_to_map_units, convert_to_point
+from scale import get_scale_from_canvas
+from translator.output import Output
+from translator.raster.process import process_raster
 from translator.utils import get_blend_mode_string
 
 MAX_NB_SYMBOL_CLASSES = 1500
 
+# output formats of vector layers:
+# (extension, GDAL driver, layer options, multi geometry type)
+VECTOR_FORMATS = {
+    "shp": ("shp", "ESRI Shapefile", [], False),
+    # features sorted in Hilbert order with packed R-tree index.
+    # driver rejects geometries of other type than layer: single are made multi
+    "fgb": ("fgb", "FlatGeobuf", ["SPATIAL_INDEX=YES"], True),
+}
+
+# providers compiling filter expressions to SQL, run with database indexes
+PUSHDOWN_PROVIDERS = ("postgres", "spatialite")
+PUSHDOWN_OGR_STORAGE_TYPES = ("GPKG", "SQLite")
+# estimated cost of an indexed query per class, in features read by a scan
+PUSHDOWN_QUERY_COST = 50000
+
+# number of geometries unioned at once when dissolving a class
+DISSOLVE_CHUNK_SIZE = 1000
+
+# data-defined properties of symbol layers baked into columns of features
+# property: (key in symbol json, suffix of column dd{symbol layer}_{suffix})
+DATA_DEFINED_PROPERTIES = {
+    QgsSymbolLayer.PropertySize: ("size", "sz"),
+    QgsSymbolLayer.PropertyWidth: ("width", "w"),
+    QgsSymbolLayer.PropertyHeight: ("height", "h"),
+    QgsSymbolLayer.PropertyAngle: ("rotation", "rot"),
+    QgsSymbolLayer.PropertyFillColor: ("color", "col"),
+    QgsSymbolLayer.PropertyStrokeColor: ("outline_color", "ocol"),
+    QgsSymbolLayer.PropertyStrokeWidth: ("outline_width", "ow"),
+}
+# line symbol layers are drawn with their stroke: color and width in json
+DATA_DEFINED_LINE_PROPERTIES = {
+    QgsSymbolLayer.PropertyStrokeColor: ("color", "col"),
+    QgsSymbolLayer.PropertyStrokeWidth: ("width", "w"),
+}
+# unit of length properties, fallback to sizeUnit if symbol layer has no getter
+DATA_DEFINED_UNIT_GETTERS = {
+    QgsSymbolLayer.PropertyWidth: "widthUnit",
+    QgsSymbolLayer.PropertyStrokeWidth: "strokeWidthUnit",
+}
+DATA_DEFINED_LINE_UNIT_GETTERS = {
+    QgsSymbolLayer.PropertyStrokeWidth: "widthUnit",
+}
+DATA_DEFINED_COLORS = (
+    QgsSymbolLayer.PropertyFillColor,
+    QgsSymbolLayer.PropertyStrokeColor,
+)
+DATA_DEFINED_LENGTHS = (
+    QgsSymbolLayer.PropertySize,
+    QgsSymbolLayer.PropertyWidth,
+    QgsSymbolLayer.PropertyHeight,
+    QgsSymbolLayer.PropertyStrokeWidth,
+)
+
+# grid of quantized coordinates when not given, in points: 0.1mm on paper
+QUANTIZE_DEFAULT_SIZE = 0.1 * 72 / 25.4
+
+# number of points transformed at once when reprojecting
+TRANSFORM_BATCH_SIZE = 10000
+
+# renderers without vector representation, always rendered as image
+RASTERIZED_RENDERERS = ("heatmapRenderer",)
+
+# field of cluster points, number of features in the cluster
+CLUSTER_COUNT_FIELD = "count"
+
+
+def _clip_geometry(
+    geometry: QgsGeometry, extent: QgsRectangle, clip_engine: QgsGeometryEngine
+) -> Optional[QgsGeometry]:
+    """
+    Clip geometry by extent, computing intersection only when needed:
+    - bbox fully inside extent: geometry is returned untouched
+    - bbox fully outside extent: dropped
+    - bbox crossing extent boundary: intersection with prepared extent
+
+    Args:
+        geometry (QgsGeometry): in Project CRS
+        extent (QgsRectangle): in Project CRS
+        clip_engine (QgsGeometryEngine): prepared engine of extent geometry
+
+    Returns:
+        Optional[QgsGeometry]: clipped geometry, None if outside of extent
+    """
+    bbox = geometry.boundingBox()
+    if extent.contains(bbox):
+        return geometry
+    if not extent.intersects(bbox):
+        return None
+
+    # prepared predicate is much cheaper than intersection
+    if not clip_engine.intersects(geometry.constGet()):
+        return None
+    clipped = clip_engine.intersection(geometry.constGet())
+    if clipped is None:
+        return None
+    return QgsGeometry(clipped)
+
+
+def _repair_features(features: Iterable[QgsFeature]) -> Iterator[QgsFeature]:
+    """skip features without geometry, make the others valid"""
+    for feature in features:
+        geometry = feature.geometry()
+        if geometry.isNull():
+            continue
+
+        # repair: same as native:fixgeometries. a single point is always valid
+        if geometry.wkbType() != QgsWkbTypes.Point and not geometry.isGeosValid():
+            feature.setGeometry(geometry.makeValid())
+        yield feature
+
+
+def _create_point_buffer(size: int) -> Tuple[QPolygonF, np.ndarray]:
+    """QPolygonF of size points and numpy view (size, 2) sharing its memory"""
+    polygon = QPolygonF()
+    polygon.fill(QPointF(), size)
+    return polygon, _view_point_buffer(polygon)
+
+
+def _view_point_buffer(polygon: QPolygonF) -> np.ndarray:
+    buffer = polygon.data()
+    buffer.setsize(len(polygon) * 2 * np.dtype(np.float64).itemsize)
+    return np.frombuffer(buffer, dtype=np.float64).reshape(-1, 2)
+
+
+def _transform_points(
+    features: list, transform: QgsCoordinateTransform
+) -> Iterator[QgsFeature]:
+    """
+    transform single point features with one call for all of them,
+    point by point if any of them fails, skipping points out of CRS domain
+    """
+    polygon, coords = _create_point_buffer(len(features))
+    coords[:] = [
+        (point.x(), point.y())
+        for point in (feature.geometry().asPoint() for feature in features)
+    ]
+
+    try:
+        transform.transformPolygon(polygon)
+    except QgsCsException:
+        yield from _transform_points_one_by_one(features, transform)
+        return
+
+    for feature, (x, y) in zip(features, _view_point_buffer(polygon).tolist()):
+        feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+        yield feature
+
+
+def _transform_points_one_by_one(
+    features: list, transform: QgsCoordinateTransform
+) -> Iterator[QgsFeature]:
+    for feature in features:
+        try:
+            point = transform.transform(feature.geometry().asPoint())
+        except QgsCsException:
+            continue
+        feature.setGeometry(QgsGeometry.fromPointXY(point))
+        yield feature
+
+
+def _transform_features(
+    features: Iterable[QgsFeature], transform: QgsCoordinateTransform
+) -> Iterator[QgsFeature]:
+    """
+    Transform geometries of features to Project CRS. Consecutive 2D single
+    points are transformed in batches, other geometries one by one.
+
+    Args:
+        features (Iterable[QgsFeature]): features in layer CRS
+        transform (QgsCoordinateTransform): layer CRS to Project CRS, reused
+
+    Yields:
+        QgsFeature: feature in Project CRS, in same order. Features failing
+            to transform, ex. out of domain of CRS, are skipped
+    """
+    batch = []
+    for feature in features:
+        geometry = feature.geometry()
+        if geometry.wkbType() == QgsWkbTypes.Point:
+            batch.append(feature)
+            if len(batch) == TRANSFORM_BATCH_SIZE:
+                yield from _transform_points(batch, transform)
+                batch = []
+            continue
+
+        # keep order of features: flush points before
+        if len(batch) > 0:
+            yield from _transform_points(batch, transform)
+            batch = []
+        try:
+            geometry.transform(transform)
+        except QgsCsException:
+            continue
+        feature.setGeometry(geometry)
+        yield feature
+
+    if len(batch) > 0:
+        yield from _transform_points(batch, transform)
+
+
+def _iter_features_in_projectcrs(
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    request: Optional[QgsFeatureRequest] = None,
+    clip: bool = True,
+) -> Iterator[QgsFeature]:
+    """
+    Stream features clipped by extent, without intermediate layers.
+    The extent is pushed to the provider as filter rect to use its spatial index,
+    then each feature is repaired, transformed and clipped in one pass;
+    points are transformed in batches.
+
+    Args:
+        layer (QgsVectorLayer): Any CRS
+        extent (QgsRectangle): in Project CRS
+        request (QgsFeatureRequest, optional): base request, ex. filtered by ids
+        clip (bool, optional): False to keep whole features intersecting extent
+            by bbox, to be masked by extent afterwards. Defaults to True.
+
+    Yields:
+        QgsFeature: clipped feature in Project CRS
+    """
+    project_crs = QgsProject.instance().crs()
+    request = QgsFeatureRequest(request) if request is not None else QgsFeatureRequest()
+
+    # no reprojection stage when layer is already in Project CRS
+    transform = None
+    if layer.crs() != project_crs:
+        transform = QgsCoordinateTransform(
+            layer.crs(), project_crs, QgsProject.instance()
+        )
+    _set_filter_rect(request, layer, extent)
+
+    # prepared once, reused for all features crossing the extent boundary
+    clip_geometry = QgsGeometry.fromRect(extent)
+    clip_engine = QgsGeometry.createGeometryEngine(clip_geometry.constGet())
+    clip_engine.prepareGeometry()
+
+    features = _repair_features(layer.getFeatures(request))
+    if transform is not None:
+        features = _transform_features(features, transform)
 
-def _clip_in_projectcrs(layer: QgsVectorLayer, extent: QgsRectangle) -> QgsVectorLayer:
+    for feature in features:
+        geometry = feature.geometry()
+        if clip:
+            geometry = _clip_geometry(geometry, extent, clip_engine)
+            if geometry is None:
+                continue
+        elif not geometry.boundingBox().intersects(extent):
+            # filter rect in layer CRS is larger than extent if transformed
+            continue
+
+        # repair or clip may produce collection, keep only parts of layer type
+        if geometry.type() != layer.geometryType():
+            geometry.convertGeometryCollectionToSubclass(layer.geometryType())
+        if geometry.isEmpty() or geometry.type() != layer.geometryType():
+            continue
+
+        feature.setGeometry(geometry)
+        yield feature
+
+
+def _generalize(
+    features: Iterable[QgsFeature], tolerance: float, stats: dict
+) -> Iterator[QgsFeature]:
+    """
+    Simplify geometries with topology-preserving simplifier of GEOS,
+    vertices closer than tolerance collapse in output
+
+    Args:
+        features (Iterable[QgsFeature]): features in Project CRS
+        tolerance (float): in Project CRS units
+        stats (dict): vertices_before and vertices_after are incremented
+    """
+    for feature in features:
+        geometry = feature.geometry()
+        vertices_before = geometry.constGet().nCoordinates()
+
+        simplified = geometry.simplify(tolerance)
+        if not simplified.isNull() and not simplified.isEmpty():
+            feature.setGeometry(simplified)
+            geometry = simplified
+
+        stats["vertices_before"] += vertices_before
+        stats["vertices_after"] += geometry.constGet().nCoordinates()
+        yield feature
+
+
+def _quantize(features: Iterable[QgsFeature], grid_size: float) -> Iterator[QgsFeature]:
     """
-    Clip layer by extent
+    Snap vertices to a grid, remove duplicate vertices the snapping creates
+    and drop Z and M values. Features collapsing by snapping are dropped
+
+    Args:
+        features (Iterable[QgsFeature]): features in Project CRS
+        grid_size (float): in Project CRS units
+    """
+    for feature in features:
+        snapped = feature.geometry().snappedToGrid(grid_size, grid_size)
+        if snapped.isNull() or snapped.isEmpty():
+            continue
+        snapped.removeDuplicateNodes()
+        snapped.get().dropZValue()
+        snapped.get().dropMValue()
+        # features can be shared by classes of rule-based renderer
+        quantized = QgsFeature(feature)
+        quantized.setGeometry(snapped)
+        yield quantized
+
+
+def _get_quantize_grid_size(options: dict) -> float:
+    """grid of coordinates in map units: given in points or derived from scale"""
+    if options["quantize_size"] > 0:
+        return convert_point_to_map_units(options["quantize_size"])
+    return convert_point_to_map_units(QUANTIZE_DEFAULT_SIZE)
+
+
+def _cull(
+    features: Iterable[QgsFeature], min_size: float, stats: dict
+) -> Iterator[QgsFeature]:
+    """
+    Drop features whose bounding box fits in a square of min_size:
+    rendered smaller than threshold at output scale
+
+    Args:
+        features (Iterable[QgsFeature]): features in Project CRS
+        min_size (float): in Project CRS units
+        stats (dict): culled is incremented
+    """
+    for feature in features:
+        bbox = feature.geometry().boundingBox()
+        if max(bbox.width(), bbox.height()) < min_size:
+            stats["culled"] += 1
+            continue
+        yield feature
+
+
+def _iter_export_features(
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    options: dict,
+    stats: dict,
+    request: Optional[QgsFeatureRequest] = None,
+) -> Iterator[QgsFeature]:
+    """
+    Stream features to export: clipped features in Project CRS,
+    then optional stages enabled in options. Quantization is run by
+    _export_class, after dissolve
 
     Args:
         layer (QgsVectorLayer): Any CRS
         extent (QgsRectangle): in Project CRS
+        options (dict): export options
+        stats (dict): statistics of optional stages, incremented while streaming
+        request (QgsFeatureRequest, optional): base request, ex. filtered by ids
+    """
+    features = _iter_features_in_projectcrs(
+        layer, extent, request, clip=not options.get("no_clip")
+    )
+
+    if options.get("cull") and layer.geometryType() != 0:
+        # same scale and DPI as symbol sizes in points
+        min_size = convert_point_to_map_units(options["cull_size"])
+        features = _cull(features, min_size, stats)
+
+    if options.get("generalize") and layer.geometryType() != 0:
+        # a pixel at output resolution, in map units
+        tolerance = convert_point_to_map_units(72 / options["dpi"])
+        features = _generalize(features, tolerance, stats)
+
+    return features
+
+
+def _set_filter_rect(
+    request: QgsFeatureRequest, layer: QgsVectorLayer, extent: QgsRectangle
+):
+    """
+    filter request by bounding box of extent in Project CRS, transformed to
+    layer CRS. Not filtered if extent can't be transformed
+    """
+    project_crs = QgsProject.instance().crs()
+    if layer.crs() == project_crs:
+        request.setFilterRect(extent)
+        return
+
+    to_layer_crs = QgsCoordinateTransform(
+        project_crs, layer.crs(), QgsProject.instance()
+    )
+    try:
+        request.setFilterRect(to_layer_crs.transformBoundingBox(extent))
+    except QgsCsException:
+        # ex. extent beyond domain of layer CRS: whole layer is read
+        pass
+
+
+def _count_vertices_over(
+    layer: QgsVectorLayer, extent: QgsRectangle, max_vertices: int
+) -> bool:
+    """
+    whether features in extent have more vertices than max_vertices.
+    geometries are not clipped, counting stops as soon as budget is exceeded
+
+    Args:
+        layer (QgsVectorLayer): Any CRS
+        extent (QgsRectangle): in Project CRS
+        max_vertices (int): budget of vertices of the layer
 
     Returns:
-        QgsVectorLayer: clipped layer in Project CRS
-    """
-
-    layer_cleaned = processing.run(
-        "native:fixgeometries",
-        {
-            "INPUT": layer,
-            "OUTPUT": "TEMPORARY_OUTPUT",
-        },
-    )["OUTPUT"]
-
-    reprojected = processing.run(
-        "native:reprojectlayer",
-        {
-            "INPUT": layer_cleaned,
-            "TARGET_CRS": QgsProject.instance().crs(),
-            "OUTPUT": "TEMPORARY_OUTPUT",
-        },
-    )["OUTPUT"]
-
-    clip_extent = f"{extent.xMinimum()}, {extent.xMaximum()}, \
-            {extent.yMinimum()}, {extent.yMaximum()}  \
-            [{QgsProject.instance().crs().authid()}]"
-
-    layer_intersected = processing.run(
-        "native:extractbyextent",
-        {
-            "INPUT": reprojected,
-            "EXTENT": clip_extent,
-            "CLIP": True,
-            "OUTPUT": "TEMPORARY_OUTPUT",
-        },
-    )["OUTPUT"]
-
-    return layer_intersected
+        bool: True if over budget
+    """
+    request = QgsFeatureRequest()
+    _set_filter_rect(request, layer, extent)
+    request.setNoAttributes()
+
+    nb_vertices = 0
+    for feature in layer.getFeatures(request):
+        geometry = feature.geometry()
+        if geometry.isNull():
+            continue
+        nb_vertices += geometry.constGet().nCoordinates()
+        if nb_vertices > max_vertices:
+            return True
+    return False
+
+
+def _get_rasterize_reason(
+    layer: QgsVectorLayer, extent: QgsRectangle, options: dict
+) -> Optional[str]:
+    """reason to render layer as image instead of vector, None to keep vector"""
+    if layer.renderer().type() in RASTERIZED_RENDERERS:
+        return "unsupported renderer as vector"
+    if options.get("rasterize") and _count_vertices_over(
+        layer, extent, options["max_vertices"]
+    ):
+        return f"more than {options['max_vertices']} vertices"
+    return None
+
+
+def _peek_features(features: Iterable[QgsFeature]) -> Optional[Iterator[QgsFeature]]:
+    """return None if features is empty, else an iterator over all of them"""
+    iterator = iter(features)
+    first = next(iterator, None)
+    if first is None:
+        return None
+    return itertools.chain([first], iterator)
 
 
 def _get_layer_type(layer: QgsVectorLayer):
@@ -77,95 +508,613 @@ def _get_layer_type(layer: QgsVectorLayer):
         return "unsupported"
 
 
-def _preprocess_layer(
-    layer: QgsVectorLayer, extent: QgsRectangle
-) -> (QgsVectorLayer, str):
-    """clip and calculate on-the-fly attribute
-    layer -> clip by extent -> if has on-the-fly attribute, calculate it -> return
+def _create_expression_context(layer: QgsVectorLayer) -> QgsExpressionContext:
+    """
+    expression context with global, project, map settings and layer scopes,
+    as when the layer is rendered in map canvas: ex. @map_scale is set
     """
-    layer_clipped = _clip_in_projectcrs(layer, extent)
+    context = QgsExpressionContext()
+    context.appendScope(QgsExpressionContextUtils.globalScope())
+    context.appendScope(QgsExpressionContextUtils.projectScope(QgsProject.instance()))
+    context.appendScope(
+        QgsExpressionContextUtils.mapSettingsScope(iface.mapCanvas().mapSettings())
+    )
+    context.appendScope(QgsExpressionContextUtils.layerScope(layer))
+    return context
+
+
+def _get_class_field_name(layer: QgsVectorLayer) -> Optional[str]:
+    """field name of renderer class attribute, None if it is an expression"""
+    field_idx = layer.fields().lookupField(layer.renderer().classAttribute())
+    if field_idx < 0:
+        return None
+    return layer.fields().at(field_idx).name()
+
+
+def _compile_class_attribute(
+    layer: QgsVectorLayer, value_type: Optional[type] = None
+) -> Tuple[Callable[[QgsFeature], Any], list, bool]:
+    """
+    Compile class attribute of the renderer once: field name or expression.
+    Expression is prepared with layer context and evaluated per feature,
+    no calculated field is materialized.
+
+    Args:
+        layer (QgsVectorLayer): layer with categorized or graduated renderer
+        value_type (type, optional): cast expression result to this type
+
+    Returns:
+        Callable[[QgsFeature], Any]: return class value of a feature
+        list: names of attributes needed to get class value
+        bool: True if geometry is needed to get class value
+    """
+    field_name = _get_class_field_name(layer)
+    if field_name is not None:
+        field_idx = layer.fields().indexOf(field_name)
+        return (lambda feature: feature.attribute(field_idx)), [field_name], False
+
+    # on-the-fly attribute
+    expression = QgsExpression(layer.renderer().classAttribute())
+    context = _create_expression_context(layer)
+    expression.prepare(context)
+
+    def evaluate(feature: QgsFeature) -> Any:
+        context.setFeature(feature)
+        value = expression.evaluate(context)
+        if value_type is None or value is None or value == NULL:
+            return value
+        try:
+            return value_type(value)
+        except (TypeError, ValueError):
+            return NULL
+
+    return evaluate, list(expression.referencedColumns()), expression.needsGeometry()
+
+
+def _generate_vector_file(
+    layer: QgsVectorLayer,
+    features: Iterable[QgsFeature],
+    path: str,
+    output_format: str,
+    fields: Optional[QgsFields] = None,
+    force_2d: bool = False,
+) -> int:
+    """
+    write features to a vector file of output format
+
+    Returns:
+        int: number of features failed to write, skipped
+    """
+    driver_name, layer_options, is_multi = VECTOR_FORMATS[output_format][1:]
+    wkb_type = QgsWkbTypes.flatType(layer.wkbType()) if force_2d else layer.wkbType()
+    if is_multi and QgsWkbTypes.geometryType(wkb_type) != 0:
+        # clip, repair and dissolve can produce multipart lines and polygons
+        wkb_type = QgsWkbTypes.multiType(wkb_type)
 
-    if layer.renderer().classAttribute() in layer.fields().names():
-        return layer_clipped, layer.renderer().classAttribute()
-    else:
-        target_field = "tmp_calc"
-        calculated_layer = processing.run(
-            "native:fieldcalculator",
-            {
-                "INPUT": layer_clipped,
-                "FIELD_NAME": target_field,
-                "FIELD_TYPE": _get_field_value_type(layer),
-                "FIELD_LENGTH": 0,
-                "FIELD_PRECISION": 0,
-                "FORMULA": f"{layer.renderer().classAttribute()}",
-                "OUTPUT": "TEMPORARY_OUTPUT",
-            },
-        )["OUTPUT"]
-        return calculated_layer, target_field
-
-
-def _generate_shapefile(layer: QgsVectorLayer, features: list, shp_path: str):
     output_layer = QgsVectorFileWriter(
-        shp_path,
+        path,
         "UTF-8",
-        layer.fields(),
-        layer.wkbType(),
+        layer.fields() if fields is None else fields,
+        wkb_type,
         QgsProject.instance().crs(),
-        "ESRI Shapefile",
+        driver_name,
+        [],
+        layer_options,
     )
-    output_layer.addFeatures(features)
+    if output_layer.hasError() != QgsVectorFileWriter.WriterError.NoError:
+        raise Exception(output_layer.errorMessage())
+
+    # one by one: features are streamed, not listed. failed ones are skipped
+    nb_failed = 0
+    for feature in features:
+        if not output_layer.addFeature(feature):
+            nb_failed += 1
     del output_layer
+    return nb_failed
 
 
-def _get_field_value_type(layer: QgsVectorLayer) -> int:
-    if layer.renderer().type() == "categorizedSymbol":
-        # enum for calculate field class
-        # https://docs.qgis.org/3.28/en/docs/user_manual/processing_algs/qgis/vectortable.html#qgisfieldcalculator
-        category_value = layer.renderer().categories()[0].value()
+def _is_other_category_value(value) -> bool:
+    """category defined with "" or NULL value means "all other values" """
+    return value == "" or value == NULL
 
-        if isinstance(category_value, float):
-            return 0
-        elif isinstance(category_value, int):
-            return 1
-        elif isinstance(category_value, str):
-            return 2
 
-    elif layer.renderer().type() == "graduatedSymbol":
-        # graduated ranges are float values
-        return 0
+def _get_category_values(category: QgsRendererCategory) -> list:
+    """values of a category, merged categories have a list of values"""
+    if isinstance(category.value(), list):
+        return category.value()
+    return [category.value()]
+
+
+def _get_category_value_type(categories: list) -> Optional[type]:
+    """type of category values, expression results are compared as this type"""
+    for category in categories:
+        for value in _get_category_values(category):
+            if isinstance(value, (float, int, str)) and not (
+                _is_other_category_value(value)
+            ):
+                return type(value)
+    return None
+
+
+def _partition_by_category(
+    features: Iterable[QgsFeature],
+    get_class_value: Callable[[QgsFeature], Any],
+    categories: list,
+) -> dict:
+    """distribute features to categories, reading features only once
+
+    Args:
+        features (Iterable[QgsFeature]): features to distribute
+        get_class_value (Callable[[QgsFeature], Any]): return category value
+        categories (list): QgsRendererCategory list of the renderer
+
+    Returns:
+        dict: {sub_idx: [QgsFeature, ...]}, sub_idx is index of category
+    """
+    buckets = {sub_idx: [] for sub_idx in range(len(categories))}
+
+    # category value -> sub_idx list, same value can be defined several times
+    value_to_sub_idxs = {}
+    # "all other values" categories: receive features not matching any value
+    other_sub_idxs = []
+    for sub_idx, category in enumerate(categories):
+        if _is_other_category_value(category.value()):
+            other_sub_idxs.append(sub_idx)
+        else:
+            for value in _get_category_values(category):
+                value_to_sub_idxs.setdefault(value, []).append(sub_idx)
+
+    for feature in features:
+        value = get_class_value(feature)
+        sub_idxs = None
+        if not _is_other_category_value(value):
+            try:
+                sub_idxs = value_to_sub_idxs.get(value)
+            except TypeError:
+                # unhashable value never matches a category
+                pass
+
+        for sub_idx in sub_idxs or other_sub_idxs:
+            buckets[sub_idx].append(feature)
+
+    return buckets
+
+
+def _supports_pushdown(layer: QgsVectorLayer) -> bool:
+    """whether filters on layer are run by an indexed database"""
+    provider = layer.dataProvider()
+    if provider.name() in PUSHDOWN_PROVIDERS:
+        return True
+    return (
+        provider.name() == "ogr"
+        and provider.storageType() in PUSHDOWN_OGR_STORAGE_TYPES
+    )
+
+
+def _should_push_down(layer: QgsVectorLayer, nb_classes: int) -> bool:
+    """
+    Cost-based choice between provider pushdown and one-pass bucketing.
+    Pushdown runs one indexed query per class, bucketing reads all features
+    in extent once: pushdown pays for large layers with few classes.
+    """
+    if not _supports_pushdown(layer):
+        return False
+
+    # expression class attribute can't use attribute index
+    if _get_class_field_name(layer) is None:
+        return False
+
+    # featureCount() is -1 when unknown
+    return nb_classes * PUSHDOWN_QUERY_COST < layer.featureCount()
+
+
+def _get_category_filter_expression(
+    field_name: str, category: QgsRendererCategory, categories: list
+) -> str:
+    """
+    Filter expression selecting features of a category, compiled to SQL by
+    provider. Same rules as _partition_by_category, "" means no filter.
+    """
+    column = QgsExpression.quotedColumnRef(field_name)
+    if not _is_other_category_value(category.value()):
+        values = _get_category_values(category)
+        if len(values) == 1:
+            return QgsExpression.createFieldEqualityExpression(field_name, values[0])
+        quoted_values = [QgsExpression.quotedValue(value) for value in values]
+        return f"{column} IN ({', '.join(quoted_values)})"
+
+    # all other values: NULL or none of defined values
+    defined_values = [
+        QgsExpression.quotedValue(value)
+        for c in categories
+        if not _is_other_category_value(c.value())
+        for value in _get_category_values(c)
+    ]
+    if len(defined_values) == 0:
+        return ""
+    return f"{column} IS NULL OR {column} NOT IN ({', '.join(defined_values)})"
+
+
+def _get_range_bounds_expression(column: str, range: QgsRendererRange) -> str:
+    """lower < value <= upper, column is quoted"""
+    lower = QgsExpression.quotedValue(range.lowerValue())
+    upper = QgsExpression.quotedValue(range.upperValue())
+    return f"{column} > {lower} AND {column} <= {upper}"
+
+
+def _get_range_filter_expression(field_name: str, sub_idx: int, ranges: list) -> str:
+    """
+    Filter expression selecting features of a range, compiled to SQL by
+    provider. Same rule as _classify_by_range: lower < value <= upper,
+    and not in an earlier range overlapping this one.
+    """
+    column = QgsExpression.quotedColumnRef(field_name)
+    range = ranges[sub_idx]
+    overlapping_ranges = [
+        _get_range_bounds_expression(column, earlier_range)
+        for earlier_range in ranges[:sub_idx]
+        if earlier_range.lowerValue() < range.upperValue()
+        and earlier_range.upperValue() > range.lowerValue()
+    ]
+    if len(overlapping_ranges) == 0:
+        return _get_range_bounds_expression(column, range)
+
+    excluded = " OR ".join(f"({expression})" for expression in overlapping_ranges)
+    return f"{_get_range_bounds_expression(column, range)} AND NOT ({excluded})"
+
+
+def _create_filter_request(filter_expression: str) -> QgsFeatureRequest:
+    request = QgsFeatureRequest()
+    if filter_expression:
+        request.setFilterExpression(filter_expression)
+    return request
+
+
+def _to_float(value) -> float:
+    """class value as float, NaN if not numeric (ex. NULL)"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _classify_by_range(
+    features: Iterable[QgsFeature],
+    get_class_value: Callable[[QgsFeature], Any],
+    ranges: list,
+) -> dict:
+    """classify features to graduated ranges
+
+    class values are read in one pass, then binned with NumPy against
+    range bounds. a value v belongs to the first range in order having
+    lower < v <= upper.
+
+    Args:
+        features (Iterable[QgsFeature]): features, geometry can be omitted
+        get_class_value (Callable[[QgsFeature], Any]): return class value
+        ranges (list): QgsRendererRange list of the renderer
+
+    Returns:
+        dict: {sub_idx: {feature id, ...}}, sub_idx is index of range
+    """
+    fids = []
+    values = []
+    for feature in features:
+        fids.append(feature.id())
+        values.append(_to_float(get_class_value(feature)))
+    fids = np.array(fids, dtype=np.int64)
+    values = np.array(values, dtype=np.float64)
+
+    lowers = np.array([r.lowerValue() for r in ranges], dtype=np.float64)
+    uppers = np.array([r.upperValue() for r in ranges], dtype=np.float64)
+
+    range_order = np.argsort(uppers, kind="stable")
+    sub_idxs = np.full(len(values), -1, dtype=np.int64)
+    if np.all(lowers[range_order[1:]] >= uppers[range_order[:-1]]):
+        # disjoint ranges: index of the range having the smallest upper
+        # bound >= value. NaN is sorted after all bounds so it gets no range
+        positions = np.searchsorted(uppers[range_order], values, side="left")
+        in_bounds = positions < len(ranges)
+        sub_idxs[in_bounds] = range_order[positions[in_bounds]]
+        # reject values below lower bound of the range: gaps between ranges
+        matched = sub_idxs >= 0
+        matched[matched] = values[matched] > lowers[sub_idxs[matched]]
+        sub_idxs[~matched] = -1
+    else:
+        # overlapping ranges: first matching range in order, as QGIS
+        for sub_idx in range(len(ranges)):
+            matched = (
+                (sub_idxs == -1)
+                & (values > lowers[sub_idx])
+                & (values <= uppers[sub_idx])
+            )
+            sub_idxs[matched] = sub_idx
+
+    # group feature ids by range with a sort, unmatched (-1) come first
+    fid_order = np.argsort(sub_idxs, kind="stable")
+    bounds = np.searchsorted(sub_idxs[fid_order], np.arange(len(ranges) + 1))
+    return {
+        sub_idx: set(fids[fid_order[bounds[sub_idx] : bounds[sub_idx + 1]]].tolist())
+        for sub_idx in range(len(ranges))
+    }
+
+
+def _dissolve(features: Iterable[QgsFeature]) -> list:
+    """
+    Union features of a class into one multipart feature,
+    attributes of the first feature are kept as native:dissolve does.
+    Large classes are unioned by chunks on a thread pool, then chunk results
+    are unioned together.
+
+    Args:
+        features (Iterable[QgsFeature]): features of a class
+
+    Returns:
+        list: one dissolved feature, empty if no feature
+    """
+    dissolved_feature = None
+    geometries = []
+    for feature in features:
+        if dissolved_feature is None:
+            dissolved_feature = feature
+        geometries.append(feature.geometry())
+
+    if dissolved_feature is None:
+        return []
+
+    with ThreadPoolExecutor() as executor:
+        while len(geometries) > DISSOLVE_CHUNK_SIZE:
+            chunks = [
+                geometries[i : i + DISSOLVE_CHUNK_SIZE]
+                for i in range(0, len(geometries), DISSOLVE_CHUNK_SIZE)
+            ]
+            geometries = list(executor.map(QgsGeometry.unaryUnion, chunks))
+
+    dissolved = QgsGeometry.unaryUnion(geometries)
+    dissolved.convertToMultiType()
+    # new feature: source features can be shared by buckets of several classes
+    dissolved_feature = QgsFeature(dissolved_feature)
+    dissolved_feature.setGeometry(dissolved)
+    return [dissolved_feature]
+
+
+def _compile_data_defined_properties(
+    symbol: QgsSymbol, context: QgsExpressionContext
+) -> list:
+    """
+    Prepare active data-defined properties of symbol layers to be evaluated
+    for each feature
+
+    Args:
+        symbol (QgsSymbol): symbol of the class
+        context (QgsExpressionContext): context of the layer
+
+    Returns:
+        list: dict of symbol_layer_idx, key in symbol json, column, property,
+            is_color, and factor to points for lengths
+    """
+    compiled = []
+    for symbol_layer_idx, symbol_layer in enumerate(symbol):
+        if symbol_layer.type() == Qgis.SymbolType.Line:
+            keys = {**DATA_DEFINED_PROPERTIES, **DATA_DEFINED_LINE_PROPERTIES}
+            unit_getters = {
+                **DATA_DEFINED_UNIT_GETTERS,
+                **DATA_DEFINED_LINE_UNIT_GETTERS,
+            }
+        else:
+            keys = DATA_DEFINED_PROPERTIES
+            unit_getters = DATA_DEFINED_UNIT_GETTERS
+
+        properties = symbol_layer.dataDefinedProperties()
+        for property_key in properties.propertyKeys():
+            if property_key not in keys:
+                continue
+            prop = properties.property(property_key)
+            if not prop.isActive():
+                continue
+
+            factor = 1.0
+            if property_key in DATA_DEFINED_LENGTHS:
+                unit = getattr(
+                    symbol_layer,
+                    unit_getters.get(property_key, "sizeUnit"),
+                    symbol_layer.outputUnit,
+                )()
+                factor = convert_to_point(1.0, unit)
+                if factor is None:
+                    # unit not convertible to points
+                    continue
+
+            prop.prepare(context)
+            key, suffix = keys[property_key]
+            compiled.append(
+                {
+                    "symbol_layer_idx": symbol_layer_idx,
+                    "key": key,
+                    "column": f"dd{symbol_layer_idx}_{suffix}",
+                    "property": prop,
+                    "is_color": property_key in DATA_DEFINED_COLORS,
+                    "factor": factor,
+                }
+            )
+    return compiled
+
+
+def _bake_data_defined_properties(
+    features: Iterable[QgsFeature],
+    data_defined: list,
+    fields: QgsFields,
+    context: QgsExpressionContext,
+) -> Iterator[QgsFeature]:
+    """
+    Append values of data-defined properties evaluated for each feature,
+    in the same pass as writing
+
+    Args:
+        features (Iterable[QgsFeature]): features of the class
+        data_defined (list): compiled by _compile_data_defined_properties
+        fields (QgsFields): fields of features followed by data-defined columns
+        context (QgsExpressionContext): context properties were prepared with
+
+    Yields:
+        QgsFeature: feature with fields
+    """
+    for feature in features:
+        context.setFeature(feature)
+        values = []
+        for dd in data_defined:
+            if dd["is_color"]:
+                color, ok = dd["property"].valueAsColor(context, QColor())
+                values.append(to_rgba(color) if ok and color.isValid() else NULL)
+            else:
+                value, ok = dd["property"].valueAsDouble(context, 0.0)
+                values.append(value * dd["factor"] if ok else NULL)
+
+        baked = QgsFeature(fields, feature.id())
+        baked.setGeometry(feature.geometry())
+        baked.setAttributes(feature.attributes() + values)
+        yield baked
+
+
+def _export_class(
+    layer: QgsVectorLayer,
+    features: Iterable[QgsFeature],
+    symbol: QgsSymbol,
+    output_name: str,
+    output: Output,
+    options: dict,
+    stats: dict,
+    legend: Optional[str] = None,
+    fields: Optional[QgsFields] = None,
+) -> bool:
+    """
+    write vector file, json and assets of features rendered with a symbol
+
+    Args:
+        layer (QgsVectorLayer): source layer
+        features (Iterable[QgsFeature]): clipped features in Project CRS
+        symbol (QgsSymbol): symbol of the class
+        output_name (str): layer_{idx} or layer_{idx}_{sub_idx}
+        output (Output): destination of files
+        options (dict): export options
+        stats (dict): statistics of export, incremented while writing
+        legend (str, optional): legend of the class, None for single symbol
+        fields (QgsFields, optional): fields of features, default to layer fields
+
+    Returns:
+        bool: True if symbol includes unsupported symbol layer
+    """
+    if options.get("dissolve") and layer.geometryType() != 0:
+        features = _dissolve(features)
+
+    if options.get("quantize"):
+        # after all geometry stages: their vertices are snapped
+        features = _quantize(features, _get_quantize_grid_size(options))
+
+    # data-defined properties evaluated while writing, as extra columns
+    context = _create_expression_context(layer)
+    data_defined = _compile_data_defined_properties(symbol, context)
+    if len(data_defined) > 0:
+        fields = QgsFields(layer.fields() if fields is None else fields)
+        for dd in data_defined:
+            fields.append(
+                QgsField(
+                    dd["column"], QVariant.String if dd["is_color"] else QVariant.Double
+                )
+            )
+        features = _bake_data_defined_properties(
+            features, data_defined, fields, context
+        )
+
+    # shp or other vector format
+    output_format = options.get("format", "shp")
+    extension = VECTOR_FORMATS[output_format][0]
+    with output.vector_file(f"{output_name}.{extension}") as vector_path:
+        stats["failed"] += _generate_vector_file(
+            layer,
+            features,
+            vector_path,
+            output_format,
+            fields,
+            force_2d=bool(options.get("quantize")),
+        )
+
+    # json
+    symbols = generate_symbols_data(symbol)
+    for dd in data_defined:
+        # column to read the value of each feature from, instead of static value
+        symbol_data = symbols[dd["symbol_layer_idx"]]
+        symbol_data.setdefault("data_defined", {})[dd["key"]] = dd["column"]
+    layer_json = {
+        "layer": layer.name(),
+        "type": _get_layer_type(layer),
+        "symbols": symbols,
+        "usingSymbolLevels": layer.renderer().usingSymbolLevels(),
+        "opacity": layer.opacity(),
+        "blend_mode": get_blend_mode_string(layer.blendMode()),
+    }
+    if legend is not None:
+        layer_json["legend"] = legend
+    output.write_json(layer_json, f"{output_name}.json")
+
+    # asset
+    export_assets_from(symbol, output)
+
+    return is_included_unsupported_symbol_layer(symbol)
 
 
 def process_vector(
-    layer: QgsVectorLayer, extent: QgsRectangle, idx: int, output_dir: str
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    idx: int,
+    output: Output,
+    options: dict,
 ) -> dict:
+    # too dense or not representable as vector: same output as raster layer
+    rasterize_reason = _get_rasterize_reason(layer, extent, options)
+    if rasterize_reason is not None:
+        result = process_raster(layer, extent, idx, output)
+        if result["completed"]:
+            result["rasterized"] = rasterize_reason
+        return result
+
+    # statistics of optional stages, filled while streaming features
+    stats = {"vertices_before": 0, "vertices_after": 0, "culled": 0, "failed": 0}
+
     if layer.renderer().type() == "categorizedSymbol":
-        result = _process_categorical(layer, extent, idx, output_dir)
+        result = _process_categorical(layer, extent, idx, output, options, stats)
     elif layer.renderer().type() == "graduatedSymbol":
-        result = _process_graduated(layer, extent, idx, output_dir)
+        result = _process_graduated(layer, extent, idx, output, options, stats)
+    elif layer.renderer().type() == "RuleRenderer":
+        result = _process_rule_based(layer, extent, idx, output, options, stats)
     elif layer.renderer().type() == "singleSymbol":
-        result = _process_singlesymbol(layer, extent, idx, output_dir)
+        result = _process_singlesymbol(layer, extent, idx, output, options, stats)
+    elif layer.renderer().type() in ("pointCluster", "pointDisplacement"):
+        result = _process_point_cluster(layer, extent, idx, output, options, stats)
     else:
-        result = _process_unsupported_renderer(layer, extent, idx, output_dir)
+        result = _process_unsupported_renderer(layer, extent, idx, output)
+
+    if options.get("generalize") and result["completed"]:
+        result["vertices"] = [stats["vertices_before"], stats["vertices_after"]]
+    if options.get("cull") and result["completed"]:
+        result["culled"] = stats["culled"]
+    if stats["failed"] > 0 and result["completed"]:
+        result["failed"] = stats["failed"]
     return result
 
 
 def _process_categorical(
-    layer: QgsVectorLayer, extent: QgsRectangle, idx: int, output_dir: str
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    idx: int,
+    output: Output,
+    options: dict,
+    stats: dict,
 ) -> dict:
-    layer_normalized, target_field = _preprocess_layer(layer, extent)
-
-    # Make uncompleted if no feature in canvas
-    if layer_normalized.featureCount() == 0:
-        return {
-            "idx": idx,
-            "layer_name": layer.name(),
-            "has_unsupported_symbol": False,
-            "reason": "no feature in canvas",
-            "completed": False,
-        }
+    categories = layer.renderer().categories()
 
     # Make uncompleted if more than 999 classes
-    if len(layer.renderer().categories()) > MAX_NB_SYMBOL_CLASSES:
+    if len(categories) > MAX_NB_SYMBOL_CLASSES:
         return {
             "idx": idx,
             "layer_name": layer.name(),
@@ -173,67 +1122,67 @@ def _process_categorical(
             "reason": f"maximum of {MAX_NB_SYMBOL_CLASSES} symbol classes is required)",
             "completed": False,
         }
-    has_unsupported_symbol = False
-
-    for sub_idx, category in enumerate(layer.renderer().categories()):
-        # extract features by category
-        if category.value() == "" or category.value() == NULL:
-            # all other values (defined with "" or NULL value)
-
-            # get list of all defined category values
-            #  → [1, 2, 4, '', NULL]
-            category_values = [cat.value() for cat in layer.renderer().categories()]
 
-            # List unempty category values (remove NULL and '' values)
-            #  → [1, 2, 4]
-            exclude_values = list(filter(None, category_values))
-
-            # Get features excluding unempty defined category values (5, 9, '', etc.)
-            filtered_features = list(
-                filter(
-                    lambda f: f[target_field] not in exclude_values,
-                    layer_normalized.getFeatures(),
-                )
+    if _should_push_down(layer, len(categories)):
+        # one query per category, filtered by provider with its indexes
+        field_name = _get_class_field_name(layer)
+        buckets = {
+            sub_idx: _iter_export_features(
+                layer,
+                extent,
+                options,
+                stats,
+                _create_filter_request(
+                    _get_category_filter_expression(field_name, category, categories)
+                ),
             )
-        else:
-            filtered_features = list(
-                filter(
-                    lambda f: f[target_field] == category.value(),
-                    layer_normalized.getFeatures(),
-                )
-            )
-
-        # no produce shp, json or asset if no feature
-        if len(filtered_features) == 0:
-            continue
-
-        # shp
-        shp_path = os.path.join(output_dir, f"layer_{idx}_{sub_idx}.shp")
-        _generate_shapefile(layer, filtered_features, shp_path)
-
-        # json
-        layer_json = {
-            "layer": layer.name(),
-            "type": _get_layer_type(layer),
-            "symbols": generate_symbols_data(category.symbol()),
-            "usingSymbolLevels": layer.renderer().usingSymbolLevels(),
-            "legend": category.label(),
-            "opacity": layer.opacity(),
-            "blend_mode": get_blend_mode_string(layer.blendMode()),
+            for sub_idx, category in enumerate(categories)
         }
-        write_json(
-            layer_json,
-            os.path.join(output_dir, f"layer_{idx}_{sub_idx}.json"),
+    else:
+        # distribute clipped features to categories in a single pass
+        get_class_value, _, _ = _compile_class_attribute(
+            layer, _get_category_value_type(categories)
+        )
+        buckets = _partition_by_category(
+            _iter_export_features(layer, extent, options, stats),
+            get_class_value,
+            categories,
         )
 
-        # asset
-        export_assets_from(category.symbol(), output_dir)
+    has_feature = False
+    has_unsupported_symbol = False
+
+    for sub_idx, category in enumerate(categories):
+        # no produce shp, json or asset if no feature
+        filtered_features = _peek_features(buckets[sub_idx])
+        if filtered_features is None:
+            continue
+        has_feature = True
 
         has_unsupported_symbol = (
-            has_unsupported_symbol
-            or is_included_unsupported_symbol_layer(category.symbol())
+            _export_class(
+                layer,
+                filtered_features,
+                category.symbol(),
+                f"layer_{idx}_{sub_idx}",
+                output,
+                options,
+                stats,
+                category.label(),
+            )
+            or has_unsupported_symbol
         )
 
+    # Make uncompleted if no feature in canvas
+    if not has_feature:
+        return {
+            "idx": idx,
+            "layer_name": layer.name(),
+            "has_unsupported_symbol": False,
+            "reason": "no feature in canvas",
+            "completed": False,
+        }
+
     return {
         "idx": idx,
         "layer_name": layer.name(),
@@ -243,12 +1192,71 @@ def _process_categorical(
 
 
 def _process_graduated(
-    layer: QgsVectorLayer, extent: QgsRectangle, idx: int, output_dir: str
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    idx: int,
+    output: Output,
+    options: dict,
+    stats: dict,
 ) -> dict:
-    layer_normalized, target_field = _preprocess_layer(layer, extent)
+    ranges = layer.renderer().ranges()
+
+    # Make uncompleted if more than 999 classes
+    if len(ranges) > MAX_NB_SYMBOL_CLASSES:
+        return {
+            "idx": idx,
+            "layer_name": layer.name(),
+            "has_unsupported_symbol": False,
+            "reason": f"maximum of {MAX_NB_SYMBOL_CLASSES} symbol classes is required)",
+            "completed": False,
+        }
+
+    if _should_push_down(layer, len(ranges)):
+        # one query per range, filtered by provider with its indexes
+        field_name = _get_class_field_name(layer)
+        features_by_range = {
+            sub_idx: _iter_export_features(
+                layer,
+                extent,
+                options,
+                stats,
+                _create_filter_request(
+                    _get_range_filter_expression(field_name, sub_idx, ranges)
+                ),
+            )
+            for sub_idx, _ in enumerate(ranges)
+        }
+    else:
+        features_by_range = _get_features_by_range(
+            layer, extent, ranges, options, stats
+        )
+
+    has_feature = False
+    has_unsupported_symbol = False
+
+    for sub_idx, range in enumerate(ranges):
+        # no produce shp, json or asset if no feature
+        filtered_features = _peek_features(features_by_range[sub_idx])
+        if filtered_features is None:
+            continue
+        has_feature = True
+
+        has_unsupported_symbol = (
+            _export_class(
+                layer,
+                filtered_features,
+                range.symbol(),
+                f"layer_{idx}_{sub_idx}",
+                output,
+                options,
+                stats,
+                range.label(),
+            )
+            or has_unsupported_symbol
+        )
 
     # Make uncompleted if no feature in canvas
-    if layer_normalized.featureCount() == 0:
+    if not has_feature:
         return {
             "idx": idx,
             "layer_name": layer.name(),
@@ -257,8 +1265,236 @@ def _process_graduated(
             "completed": False,
         }
 
+    return {
+        "idx": idx,
+        "layer_name": layer.name(),
+        "has_unsupported_symbol": has_unsupported_symbol,
+        "completed": True,
+    }
+
+
+def _get_features_by_range(
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    ranges: list,
+    options: dict,
+    stats: dict,
+) -> dict:
+    """
+    classify features in extent with one scan of class values,
+    then fetch geometries range by range by feature id
+
+    Returns:
+        dict: {sub_idx: Iterable[QgsFeature]}, sub_idx is index of range
+    """
+    # read only class values of features in extent, without geometry if possible
+    get_class_value, class_attributes, needs_geometry = _compile_class_attribute(layer)
+    request = QgsFeatureRequest()
+    request.setSubsetOfAttributes(class_attributes, layer.fields())
+    if needs_geometry:
+        # evaluate on clipped geometry in Project CRS
+        features = _iter_features_in_projectcrs(layer, extent, request)
+    else:
+        request.setFlags(QgsFeatureRequest.Flag.NoGeometry)
+        _set_filter_rect(request, layer, extent)
+        features = layer.getFeatures(request)
+
+    fids_by_range = _classify_by_range(features, get_class_value, ranges)
+
+    return {
+        sub_idx: (
+            _iter_export_features(
+                layer, extent, options, stats, QgsFeatureRequest().setFilterFids(fids)
+            )
+            if len(fids) > 0
+            else []
+        )
+        for sub_idx, fids in fids_by_range.items()
+    }
+
+
+def _compile_rules(
+    rule: QgsRuleBasedRenderer.Rule,
+    context: QgsExpressionContext,
+    scale: float,
+    symbol_rules: list,
+) -> list:
+    """
+    Compile children of rule once: inactive rules and rules out of scale range
+    are pruned, filter expressions are prepared.
+
+    Args:
+        rule (QgsRuleBasedRenderer.Rule): parent rule, root rule at first
+        context (QgsExpressionContext): context to prepare expressions with
+        scale (float): export scale
+        symbol_rules (list): rules having symbol are appended, index is sub_idx
+
+    Returns:
+        list: compiled rules,
+            {"expression", "is_else", "is_active", "sub_idx", "children"}.
+            Inactive rules render nothing but their filter still blocks
+            else rules, as in QgsRuleBasedRenderer
+    """
+    compiled_rules = []
+    for child in rule.children():
+        if not child.isScaleOK(scale):
+            continue
+
+        expression = None
+        if not child.isElse() and child.filterExpression():
+            expression = QgsExpression(child.filterExpression())
+            expression.prepare(context)
+
+        if not child.active():
+            compiled_rules.append(
+                {
+                    "expression": expression,
+                    "is_else": child.isElse(),
+                    "is_active": False,
+                    "sub_idx": None,
+                    "children": [],
+                }
+            )
+            continue
+
+        sub_idx = None
+        if child.symbol() is not None:
+            sub_idx = len(symbol_rules)
+            symbol_rules.append(child)
+
+        compiled_rules.append(
+            {
+                "expression": expression,
+                "is_else": child.isElse(),
+                "is_active": True,
+                "sub_idx": sub_idx,
+                "children": _compile_rules(child, context, scale, symbol_rules),
+            }
+        )
+    return compiled_rules
+
+
+def _match_rules(compiled_rules: list, context: QgsExpressionContext) -> list:
+    """
+    sub_idx of rules rendering the feature set to context.
+    As QgsRuleBasedRenderer, else rules are evaluated only when no sibling
+    rule matches: renders the feature, or is inactive with its filter passing.
+    """
+    sub_idxs = []
+    else_rules = []
+    matched = False
+    for compiled_rule in compiled_rules:
+        if compiled_rule["is_else"]:
+            else_rules.append(compiled_rule)
+            continue
+
+        rule_matched, rule_sub_idxs = _match_rule(compiled_rule, context)
+        matched = matched or rule_matched
+        sub_idxs.extend(rule_sub_idxs)
+
+    if not matched:
+        for compiled_rule in else_rules:
+            sub_idxs.extend(_match_rule(compiled_rule, context)[1])
+
+    return sub_idxs
+
+
+def _match_rule(
+    compiled_rule: dict, context: QgsExpressionContext
+) -> Tuple[bool, list]:
+    """
+    Same results as QgsRuleBasedRenderer.Rule.renderFeature:
+    matched if Rendered or Inactive, not if Filtered, that is filter failing
+    or rule without symbol of which no descendant renders the feature
+
+    Returns:
+        Tuple[bool, list]: matched, sub_idx of the rule and of its descendants
+            rendering the feature
+    """
+    expression = compiled_rule["expression"]
+    if expression is not None and not expression.evaluate(context):
+        return False, []
+    if not compiled_rule["is_active"]:
+        return True, []
+
+    sub_idxs = []
+    if compiled_rule["sub_idx"] is not None:
+        sub_idxs.append(compiled_rule["sub_idx"])
+    sub_idxs.extend(_match_rules(compiled_rule["children"], context))
+    return len(sub_idxs) > 0, sub_idxs
+
+
+def _iter_rule_expressions(compiled_rules: list) -> Iterator[QgsExpression]:
+    """filter expressions of compiled rules and of their descendants"""
+    for compiled_rule in compiled_rules:
+        if compiled_rule["expression"] is not None:
+            yield compiled_rule["expression"]
+        yield from _iter_rule_expressions(compiled_rule["children"])
+
+
+def _classify_by_rule(
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    compiled_rules: list,
+    nb_rules: int,
+    context: QgsExpressionContext,
+) -> dict:
+    """
+    evaluate rules on features in extent in one scan, reading only attributes
+    of filters, and geometries if a filter needs them
+
+    Args:
+        layer (QgsVectorLayer): layer with rule-based renderer
+        extent (QgsRectangle): in Project CRS
+        compiled_rules (list): output of _compile_rules
+        nb_rules (int): number of rules having symbol
+        context (QgsExpressionContext): context rules were prepared with
+
+    Returns:
+        dict: {sub_idx: set of feature ids}, sub_idx is index of rule
+    """
+    attributes = set()
+    needs_geometry = False
+    for expression in _iter_rule_expressions(compiled_rules):
+        attributes.update(expression.referencedColumns())
+        needs_geometry = needs_geometry or expression.needsGeometry()
+
+    request = QgsFeatureRequest()
+    if QgsFeatureRequest.ALL_ATTRIBUTES not in attributes:
+        request.setSubsetOfAttributes(list(attributes), layer.fields())
+    if needs_geometry:
+        # evaluate on clipped geometry in Project CRS
+        features = _iter_features_in_projectcrs(layer, extent, request)
+    else:
+        request.setFlags(QgsFeatureRequest.Flag.NoGeometry)
+        _set_filter_rect(request, layer, extent)
+        features = layer.getFeatures(request)
+
+    fids_by_rule = {sub_idx: set() for sub_idx in range(nb_rules)}
+    for feature in features:
+        context.setFeature(feature)
+        for sub_idx in _match_rules(compiled_rules, context):
+            fids_by_rule[sub_idx].add(feature.id())
+    return fids_by_rule
+
+
+def _process_rule_based(
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    idx: int,
+    output: Output,
+    options: dict,
+    stats: dict,
+) -> dict:
+    # compile rule tree once at export scale
+    context = _create_expression_context(layer)
+    symbol_rules = []
+    compiled_rules = _compile_rules(
+        layer.renderer().rootRule(), context, get_scale_from_canvas(), symbol_rules
+    )
+
     # Make uncompleted if more than 999 classes
-    if len(layer.renderer().ranges()) > MAX_NB_SYMBOL_CLASSES:
+    if len(symbol_rules) > MAX_NB_SYMBOL_CLASSES:
         return {
             "idx": idx,
             "layer_name": layer.name(),
@@ -267,51 +1503,56 @@ def _process_graduated(
             "completed": False,
         }
 
-    has_unsupported_symbol = False
+    # evaluate rules in a single pass keeping feature ids only, then fetch
+    # geometries rule by rule: a feature can be rendered by several rules
+    fids_by_rule = _classify_by_rule(
+        layer, extent, compiled_rules, len(symbol_rules), context
+    )
 
-    for sub_idx, range in enumerate(layer.renderer().ranges()):
-        # filter features
-        # 1: filter out null value: on-the-fly attribute may have null value
-        # 2: extract features by range
-        filtered_features = list(
-            filter(
-                lambda f: f[target_field] is not None
-                and range.lowerValue() < f[target_field] <= range.upperValue(),
-                layer_normalized.getFeatures(),
-            )
-        )
+    has_feature = False
+    has_unsupported_symbol = False
 
+    for sub_idx, rule in enumerate(symbol_rules):
         # no produce shp, json or asset if no feature
-        if len(filtered_features) == 0:
+        if len(fids_by_rule[sub_idx]) == 0:
             continue
-
-        # shp
-        shp_path = os.path.join(output_dir, f"layer_{idx}_{sub_idx}.shp")
-        _generate_shapefile(layer, filtered_features, shp_path)
-
-        # json
-        layer_json = {
-            "layer": layer.name(),
-            "type": _get_layer_type(layer),
-            "symbols": generate_symbols_data(range.symbol()),
-            "usingSymbolLevels": layer.renderer().usingSymbolLevels(),
-            "legend": range.label(),
-            "opacity": layer.opacity(),
-            "blend_mode": get_blend_mode_string(layer.blendMode()),
-        }
-        write_json(
-            layer_json,
-            os.path.join(output_dir, f"layer_{idx}_{sub_idx}.json"),
+        filtered_features = _peek_features(
+            _iter_export_features(
+                layer,
+                extent,
+                options,
+                stats,
+                QgsFeatureRequest().setFilterFids(fids_by_rule[sub_idx]),
+            )
         )
-
-        # asset
-        export_assets_from(range.symbol(), output_dir)
+        if filtered_features is None:
+            continue
+        has_feature = True
 
         has_unsupported_symbol = (
-            has_unsupported_symbol
-            or is_included_unsupported_symbol_layer(range.symbol())
+            _export_class(
+                layer,
+                filtered_features,
+                rule.symbol(),
+                f"layer_{idx}_{sub_idx}",
+                output,
+                options,
+                stats,
+                rule.label(),
+            )
+            or has_unsupported_symbol
         )
 
+    # Make uncompleted if no feature in canvas
+    if not has_feature:
+        return {
+            "idx": idx,
+            "layer_name": layer.name(),
+            "has_unsupported_symbol": False,
+            "reason": "no feature in canvas",
+            "completed": False,
+        }
+
     return {
         "idx": idx,
         "layer_name": layer.name(),
@@ -321,12 +1562,17 @@ def _process_graduated(
 
 
 def _process_singlesymbol(
-    layer: QgsVectorLayer, extent: QgsRectangle, idx: int, output_dir: str
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    idx: int,
+    output: Output,
+    options: dict,
+    stats: dict,
 ) -> dict:
-    layer_intersected = _clip_in_projectcrs(layer, extent)
+    features = _peek_features(_iter_export_features(layer, extent, options, stats))
 
     # no produce shp, json or asset if no feature
-    if layer_intersected.featureCount() == 0:
+    if features is None:
         return {
             "idx": idx,
             "layer_name": layer.name(),
@@ -335,31 +1581,204 @@ def _process_singlesymbol(
             "completed": False,
         }
 
-    # shp
-    shp_path = os.path.join(output_dir, f"layer_{idx}.shp")
-    _generate_shapefile(layer, layer_intersected.getFeatures(), shp_path)
+    has_unsupported_symbol = _export_class(
+        layer,
+        features,
+        layer.renderer().symbol(),
+        f"layer_{idx}",
+        output,
+        options,
+        stats,
+    )
 
-    # json
-    layer_json = {
-        "layer": layer.name(),
-        "type": _get_layer_type(layer),
-        "symbols": generate_symbols_data(layer.renderer().symbol()),
-        "usingSymbolLevels": layer.renderer().usingSymbolLevels(),
-        "opacity": layer.opacity(),
-        "blend_mode": get_blend_mode_string(layer.blendMode()),
+    return {
+        "idx": idx,
+        "layer_name": layer.name(),
+        "has_unsupported_symbol": has_unsupported_symbol,
+        "completed": True,
     }
-    write_json(
-        layer_json,
-        os.path.join(output_dir, f"layer_{idx}.json"),
+
+
+def _get_cluster_tolerance(renderer) -> float:
+    """distance of clustering of a point distance renderer, in map units"""
+    if renderer.toleranceUnit() == QgsUnitTypes.RenderMapUnits:
+        return renderer.tolerance()
+    tolerance = convert_to_point(renderer.tolerance(), renderer.toleranceUnit())
+    return convert_point_to_map_units(tolerance or 0)
+
+
+def _get_point(geometry: QgsGeometry) -> QgsPointXY:
+    if geometry.isMultipart():
+        return geometry.centroid().asPoint()
+    return geometry.asPoint()
+
+
+def _cluster_points(
+    features: Iterable[QgsFeature], tolerance: float
+) -> Tuple[list, list]:
+    """
+    Group points by grid cells of tolerance size, as renderer groups points
+    closer than tolerance at render time
+
+    Args:
+        features (Iterable[QgsFeature]): point features in Project CRS
+        tolerance (float): size of grid cells, in map units
+
+    Returns:
+        list: features not grouped with others
+        list: (center, count) of each cluster of 2 or more features
+    """
+    features = list(features)
+    if len(features) == 0:
+        return [], []
+
+    points = [_get_point(feature.geometry()) for feature in features]
+    xs = np.fromiter((point.x() for point in points), dtype=float, count=len(points))
+    ys = np.fromiter((point.y() for point in points), dtype=float, count=len(points))
+
+    # same cell, same cluster. only identical points are grouped if tolerance is 0
+    if tolerance > 0:
+        cells = np.stack([np.floor(xs / tolerance), np.floor(ys / tolerance)], axis=1)
+    else:
+        cells = np.stack([xs, ys], axis=1)
+    _, cell_idxs, counts = np.unique(
+        cells, axis=0, return_inverse=True, return_counts=True
     )
+    cell_idxs = cell_idxs.reshape(-1)
 
-    # asset
-    export_assets_from(layer.renderer().symbol(), output_dir)
+    # cluster is drawn at center of its points
+    center_xs = np.bincount(cell_idxs, weights=xs) / counts
+    center_ys = np.bincount(cell_idxs, weights=ys) / counts
+
+    singles = [
+        feature for feature, count in zip(features, counts[cell_idxs]) if count == 1
+    ]
+    clusters = [
+        (QgsPointXY(x, y), int(count))
+        for x, y, count in zip(center_xs, center_ys, counts)
+        if count > 1
+    ]
+    return singles, clusters
+
+
+def _partition_by_legend_key(
+    layer: QgsVectorLayer, renderer, features: Iterable[QgsFeature]
+) -> dict:
+    """
+    distribute features to legend items of renderer
+
+    Returns:
+        dict: {legend key: list of features}
+    """
+    render_context = QgsRenderContext.fromMapSettings(iface.mapCanvas().mapSettings())
+    render_context.setExpressionContext(_create_expression_context(layer))
+
+    buckets = {}
+    renderer.startRender(render_context, layer.fields())
+    try:
+        for feature in features:
+            render_context.expressionContext().setFeature(feature)
+            for key in renderer.legendKeysForFeature(feature, render_context):
+                buckets.setdefault(key, []).append(feature)
+    finally:
+        renderer.stopRender(render_context)
+    return buckets
+
+
+def _process_point_cluster(
+    layer: QgsVectorLayer,
+    extent: QgsRectangle,
+    idx: int,
+    output: Output,
+    options: dict,
+    stats: dict,
+) -> dict:
+    renderer = layer.renderer()
+    # features not in cluster are rendered by embedded renderer
+    embedded_renderer = renderer.embeddedRenderer().clone()
+    legend_items = [
+        item for item in embedded_renderer.legendSymbolItems() if item.symbol()
+    ]
+
+    # Make uncompleted if more than 999 classes
+    if len(legend_items) + 1 > MAX_NB_SYMBOL_CLASSES:
+        return {
+            "idx": idx,
+            "layer_name": layer.name(),
+            "has_unsupported_symbol": False,
+            "reason": f"maximum of {MAX_NB_SYMBOL_CLASSES} symbol classes is required)",
+            "completed": False,
+        }
 
-    has_unsupported_symbol = is_included_unsupported_symbol_layer(
-        layer.renderer().symbol()
+    # clusters at export scale
+    singles, clusters = _cluster_points(
+        _iter_export_features(layer, extent, options, stats),
+        _get_cluster_tolerance(renderer),
     )
 
+    # Make uncompleted if no feature in canvas
+    if len(singles) == 0 and len(clusters) == 0:
+        return {
+            "idx": idx,
+            "layer_name": layer.name(),
+            "has_unsupported_symbol": False,
+            "reason": "no feature in canvas",
+            "completed": False,
+        }
+
+    has_unsupported_symbol = False
+
+    buckets = _partition_by_legend_key(layer, embedded_renderer, singles)
+    for sub_idx, item in enumerate(legend_items):
+        # no produce shp, json or asset if no feature
+        if len(buckets.get(item.ruleKey(), [])) == 0:
+            continue
+
+        has_unsupported_symbol = (
+            _export_class(
+                layer,
+                buckets[item.ruleKey()],
+                item.symbol(),
+                f"layer_{idx}_{sub_idx}",
+                output,
+                options,
+                stats,
+                item.label(),
+            )
+            or has_unsupported_symbol
+        )
+
+    # one point per cluster with number of features, above single features
+    if len(clusters) > 0:
+        fields = QgsFields()
+        fields.append(QgsField(CLUSTER_COUNT_FIELD, QVariant.Int))
+        cluster_features = []
+        for center, count in clusters:
+            feature = QgsFeature(fields)
+            feature.setGeometry(QgsGeometry.fromPointXY(center))
+            feature.setAttributes([count])
+            cluster_features.append(feature)
+
+        if renderer.type() == "pointCluster":
+            cluster_symbol = renderer.clusterSymbol()
+        else:
+            cluster_symbol = renderer.centerSymbol()
+
+        has_unsupported_symbol = (
+            _export_class(
+                layer,
+                cluster_features,
+                cluster_symbol,
+                f"layer_{idx}_{len(legend_items)}",
+                output,
+                options,
+                stats,
+                "cluster",
+                fields,
+            )
+            or has_unsupported_symbol
+        )
+
     return {
         "idx": idx,
         "layer_name": layer.name(),
@@ -369,7 +1788,7 @@ def _process_singlesymbol(
 
 
 def _process_unsupported_renderer(
-    layer: QgsVectorLayer, extent: QgsRectangle, idx: int, output_dir: str
+    layer: QgsVectorLayer, extent: QgsRectangle, idx: int, output: Output
 ) -> dict:
     return {
         "idx": idx,
@@ -1,16 +1,11 @@
-import os
-import shutil
-
 from qgis.core import Qgis, QgsSymbol
 
 from .line import get_line_symbol_data
 from .marker import get_point_symbol_data
 from .fill import get_polygon_symbol_data
 from .hybrid import get_hybrid_symbol_data
-from translator.vector.symbol.utils import (
-    get_asset_dir,
-    get_asset_name,
-)
+from translator.output import Output
+from translator.vector.symbol.utils import ASSETS_DIR, get_asset_name
 
 
 def generate_symbols_data(symbol: QgsSymbol):
@@ -30,25 +25,20 @@ def generate_symbols_data(symbol: QgsSymbol):
     return symbols
 
 
-def export_assets_from(symbol: QgsSymbol, output_dir: str):
-    asset_dir = get_asset_dir(output_dir)
-    if not os.path.exists(asset_dir):
-        os.makedirs(asset_dir)
-
+def export_assets_from(symbol: QgsSymbol, output: Output):
     for symbol_layer in symbol:
         if symbol_layer.subSymbol():
             # recursive: if the symbol layer has sub symbol, extract from it
-            export_assets_from(symbol_layer.subSymbol(), output_dir)
+            export_assets_from(symbol_layer.subSymbol(), output)
 
         if symbol_layer.type() == Qgis.SymbolType.Marker:
             # extract only raster or svg marker
             if symbol_layer.layerType() not in ["RasterMarker", "SvgMarker"]:
                 continue  # if not, skip
 
-            asset_path = os.path.join(asset_dir, get_asset_name(symbol_layer))
-            shutil.copy(
+            output.copy_file(
                 symbol_layer.path(),
-                asset_path,
+                f"{ASSETS_DIR}/{get_asset_name(symbol_layer)}",
             )
 
 
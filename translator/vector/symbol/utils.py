@@ -5,8 +5,8 @@ from qgis.PyQt.QtGui import QColor
 from plugx_utils import convert_to_point
 
 
-def get_asset_dir(output_dir: str):
-    return os.path.join(output_dir, "assets")
+# folder of assets in output, assets_path of project.json
+ASSETS_DIR = "assets"
 
 
 def get_asset_name(symbol_layer: QgsSymbolLayer):
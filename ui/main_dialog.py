@@ -1,5 +1,4 @@
 import os
-import shutil
 
 import webbrowser
 
@@ -21,10 +20,9 @@ from qgis.PyQt.QtCore import Qt
 from qgis.PyQt.QtWidgets import QDialog, QMessageBox, QTreeWidgetItem, QFileDialog
 from qgis.PyQt.QtGui import QIcon
 
-from translator.vector.label import generate_label_vector
 from ui.progress_dialog import ProgressDialog
 from translator.thread import ProcessingThread
-from plugx_utils import write_json, get_tempdir
+from translator.output import FolderOutput, PackageOutput
 from scale import get_scale_from_canvas, set_map_extent_from
 
 from qgis.PyQt.QtCore import QT_VERSION_STR
@@ -48,6 +46,10 @@ class MainDialog(QDialog):
         self.init_ui()
 
     def init_ui(self):
+        # output formats of vector layers
+        self.ui.comboBox_format.addItem("ESRI Shapefile", "shp")
+        self.ui.comboBox_format.addItem("FlatGeobuf", "fgb")
+
         # connect signals
         self.ui.pushButton_run.clicked.connect(self._run)
         self.ui.pushButton_cancel.clicked.connect(self.close)
@@ -86,22 +88,48 @@ class MainDialog(QDialog):
     def _run(self):
         layers = self._get_checked_layers()
 
-        output_dir = QFileDialog.getExistingDirectory(self, "Select Folder")
-        if output_dir == "":
-            return
+        if self.ui.checkBox_package.isChecked():
+            # single zip file: no loose files on slow file systems
+            zip_path, _ = QFileDialog.getSaveFileName(
+                self, "Save Package", "", "Zip (*.zip)"
+            )
+            if zip_path == "":
+                return
+            output = PackageOutput(
+                zip_path, compress_png=not self.ui.checkBox_store_png.isChecked()
+            )
+        else:
+            output_dir = QFileDialog.getExistingDirectory(self, "Select Folder")
+            if output_dir == "":
+                return
+            output = FolderOutput(output_dir)
 
         params = {
             "extent": self.ui.mExtentGroupBox.outputExtent(),
-            "output_dir": output_dir,
+            "output": output,
+            "options": {
+                "generalize": self.ui.checkBox_generalize.isChecked(),
+                "dpi": self.ui.spinBox_dpi.value(),
+                "cull": self.ui.checkBox_cull.isChecked(),
+                "cull_size": self.ui.doubleSpinBox_cull_size.value(),
+                "dissolve": self.ui.checkBox_dissolve.isChecked(),
+                "rasterize": self.ui.checkBox_rasterize.isChecked(),
+                "max_vertices": self.ui.spinBox_max_vertices.value(),
+                "no_clip": self.ui.checkBox_no_clip.isChecked(),
+                "tile_labels": self.ui.checkBox_tile_labels.isChecked(),
+                "label_metrics": self.ui.checkBox_label_metrics.isChecked(),
+                "label_columnar": self.ui.checkBox_label_columnar.isChecked(),
+                "label_precision": self.ui.spinBox_label_precision.value(),
+                "format": self.ui.comboBox_format.currentData(),
+                "quantize": self.ui.checkBox_quantize.isChecked(),
+                "quantize_size": self.ui.doubleSpinBox_quantize_size.value(),
+            },
         }
 
-        # generate label vector includes labels of all layers
-        all_labels = generate_label_vector(params["extent"])
-
         # orchestrate thread and progress dialog
-        thread = ProcessingThread(layers, all_labels, params)
+        thread = ProcessingThread(layers, params)
         progress_dialog = ProgressDialog(thread.set_abort_flag)
-        progress_dialog.set_maximum(len(layers))
+        progress_dialog.set_maximum(len(layers) + 1)  # labels and layers
         # connect signals
         thread.addProgress.connect(progress_dialog.add_progress)
         thread.postMessage.connect(progress_dialog.set_messsage)
@@ -142,6 +170,40 @@ class MainDialog(QDialog):
             )
         )
 
+        # list-up vertex reduction of generalized layers
+        layers_generalized = list(
+            map(
+                lambda r: (
+                    f"{r['layer_name']} : {r['vertices'][0]} → {r['vertices'][1]}"
+                ),
+                list(filter(lambda r: "vertices" in r, results)),
+            )
+        )
+
+        # list-up number of features culled by size
+        layers_culled = list(
+            map(
+                lambda r: f"{r['layer_name']} : {r['culled']}",
+                list(filter(lambda r: r.get("culled", 0) > 0, results)),
+            )
+        )
+
+        # list-up number of features failed to write
+        layers_failed = list(
+            map(
+                lambda r: f"{r['layer_name']} : {r['failed']}",
+                list(filter(lambda r: r.get("failed", 0) > 0, results)),
+            )
+        )
+
+        # list-up vector layers exported as image and its reason
+        layers_rasterized = list(
+            map(
+                lambda r: f"{r['layer_name']} : {r['rasterized']}",
+                list(filter(lambda r: "rasterized" in r, results)),
+            )
+        )
+
         # list-up layers processed successfully: layer_0, layer_2, layer_5, ...
         layers_processed_successfully = list(
             map(
@@ -168,17 +230,26 @@ class MainDialog(QDialog):
             "scale": get_scale_from_canvas(),
             "layers": layers_processed_successfully,  # layer_0,2,5..
             "assets_path": "assets",
+            "format": params["options"]["format"],
         }
-        write_json(
-            project_json,
-            os.path.join(params["output_dir"], "project.json"),
-        )
+        if params["options"]["no_clip"]:
+            # features are not cut at extent: PlugX masks them with this polygon
+            extent = params["extent"]
+            project_json["clip_mask"] = [
+                [extent.xMinimum(), extent.yMinimum()],
+                [extent.xMaximum(), extent.yMinimum()],
+                [extent.xMaximum(), extent.yMaximum()],
+                [extent.xMinimum(), extent.yMaximum()],
+                [extent.xMinimum(), extent.yMinimum()],
+            ]
+        output.write_json(project_json, "project.json")
+        output.close()
 
         # messaging
         msg = self.tr("Process completed")
         msg += "\n\n"
         msg += self.tr("Output folder")
-        msg += f":\n{params['output_dir']}"
+        msg += f":\n{output.location()}"
 
         if len(layers_has_unsupported_symbol) > 0:
             msg += "\n\n"
@@ -186,6 +257,30 @@ class MainDialog(QDialog):
             msg += self.tr("and have been converted to simple symbols.")
             msg += "\n\n".join(layers_has_unsupported_symbol)
 
+        if len(layers_generalized) > 0:
+            msg += "\n\n"
+            msg += self.tr("Number of vertices reduced by simplification:")
+            msg += "\n"
+            msg += "\n".join(layers_generalized)
+
+        if len(layers_culled) > 0:
+            msg += "\n\n"
+            msg += self.tr("Number of features removed as smaller than threshold:")
+            msg += "\n"
+            msg += "\n".join(layers_culled)
+
+        if len(layers_failed) > 0:
+            msg += "\n\n"
+            msg += self.tr("Number of features failed to write:")
+            msg += "\n"
+            msg += "\n".join(layers_failed)
+
+        if len(layers_rasterized) > 0:
+            msg += "\n\n"
+            msg += self.tr("The following vector layers have been exported as images.")
+            msg += "\n"
+            msg += "\n".join(layers_rasterized)
+
         if len(layers_not_completed) > 0:
             msg += "\n\n"
             msg += self.tr("Failed to export the following layers.")
@@ -196,19 +291,6 @@ class MainDialog(QDialog):
             msg,
         )
 
-        # remove temp dir including intermediate files
-        try:
-            shutil.rmtree(get_tempdir(params["output_dir"]))
-        # if dir is locked by process
-        except PermissionError:
-            QMessageBox.warning(
-                self,
-                self.tr("Error"),
-                self.tr(
-                    "Failed to delete the temporary folder. Please delete it manually."
-                ),
-            )
-
     def _get_checked_layers(self):
         layers = []
         # QTreeWidgetの子要素を再帰的に取得する
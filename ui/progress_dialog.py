@@ -66,6 +66,7 @@ class ProgressDialog(QDialog):
         """translate messages coming from outside UI"""
         message_dic = {
             "Processing: ": self.tr("Processing: "),
+            "Extracting labels": self.tr("Extracting labels"),
         }
         translated_message = message_dic.get(
             message, message